@@ -41,7 +41,7 @@ def __mk_kecapi(inverse: bool, is_positive: bool):
     def mk_re():
         harp_range = tuple(range(20, 110))
         se = sound.PyteqEngine(
-            preset='"Concert Harp Recording"', available_midi_notes=harp_range
+            preset="Concert Harp Recording", available_midi_notes=harp_range
         )
         return se
 
@@ -6,7 +6,6 @@ from nongkrong.render import sound
 from mu.mel import ji
 
 import functools
-import itertools
 import operator
 
 
@@ -39,9 +38,7 @@ def __mk_kendang():
                 msg = "Unknonw octave {0} of pitch {1}".format(octave, pitch)
                 raise ValueError(msg)
 
-            return itertools.cycle(
-                ("{0}{1}.wav".format(basic_path, idx), 1) for idx in range(2)
-            )
+            return tuple(("{0}{1}.wav".format(basic_path, idx), 1) for idx in range(2))
 
         pitch2sample = {pitch: mk_pitch2samples(pitch) for pitch in pitches}
 
@@ -26,7 +26,7 @@ def __mk_siter_barung():
         )
 
     def mk_re():
-        return sound.PyteqEngine(preset='"Cimbalom hard"')
+        return sound.PyteqEngine(preset="Cimbalom hard")
 
     pitches0 = mk_pitches(False)
     pitches1 = mk_pitches(True)
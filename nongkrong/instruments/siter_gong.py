@@ -21,7 +21,7 @@ def __mk_siter_gong_complete():
         return (tuple(p.normalize(2) + octave for p in pitches[0]), pitches[1])
 
     def mk_re():
-        return sound.PyteqEngine(preset='"Cimbalom hard"')
+        return sound.PyteqEngine(preset="Cimbalom hard")
 
     pitches_gong = mk_combination_pitches(3, ji.r(1, 4))
     pitches_tong = mk_combination_pitches(2, ji.r(1, 2))
@@ -66,7 +66,7 @@ def __mk_siter_gong_simplified():
         return tuple(p.normalize(2) + octave for p in pitches[0]), pitches[1]
 
     def mk_re():
-        return sound.PyteqEngine(preset='"Cimbalom hard"')
+        return sound.PyteqEngine(preset="Cimbalom hard")
 
     pitch_gong_plus = ji.r(3 * 5 * 7, 1).normalize(2) + ji.r(1, 4)
     pitch_gong_minus = pitch_gong_plus.inverse().normalize(2) + ji.r(1, 4)
@@ -1,5 +1,3 @@
-import itertools
-
 from nongkrong.instruments import instruments
 from nongkrong.harmony import shortwriting as sw
 from nongkrong.render import notation
@@ -10,29 +8,29 @@ from mu.mel import ji
 
 def __mk_tak():
     def mk_re():
-        def mk_tak_cycle():
+        def mk_tak_samples():
             names = tuple("samples/klapper/{0}.wav".format(idx) for idx in range(5))
-            return itertools.cycle(tuple((n, 1, 0.59) for n in names))
+            return tuple((n, 1, 0.59) for n in names)
 
-        def mk_schlitz_kurz_cycle():
+        def mk_schlitz_kurz_samples():
             names = tuple(
                 "samples/schlitztrommel/kurz/{0}.wav".format(idx) for idx in range(6)
             )
-            return itertools.cycle(tuple((n, 1, 1.1) for n in names))
+            return tuple((n, 1, 1.1) for n in names)
 
-        def mk_schlitz_lang_cycle():
+        def mk_schlitz_lang_samples():
             names = tuple(
                 "samples/schlitztrommel/lang/{0}.wav".format(idx) for idx in range(5)
             )
-            return itertools.cycle(tuple((n, 1, 1.1) for n in names))
+            return tuple((n, 1, 1.1) for n in names)
 
         short_pitch = ji.r(1, 1)
         long_pitch = ji.r(1, 2)
         tak_pitch = ji.r(3, 2)
         pitch2sample = {
-            tak_pitch: mk_tak_cycle(),
-            short_pitch: mk_schlitz_kurz_cycle(),
-            long_pitch: mk_schlitz_lang_cycle(),
+            tak_pitch: mk_tak_samples(),
+            short_pitch: mk_schlitz_kurz_samples(),
+            long_pitch: mk_schlitz_lang_samples(),
         }
 
         return sound.SampleEngine(pitch2sample)
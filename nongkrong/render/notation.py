@@ -709,8 +709,11 @@ class Document(object):
         doc.preamble.append(pylatex.NoEscape(r"\pagestyle{fancy}"))
         return doc
 
-    def render(self, path: str) -> None:
+    def mk_document(self) -> pylatex.Document:
         document = self.mk_basic_doc()
         for section in self.sections:
             section.add2document(document)
-        document.generate_pdf(path + self.name, clean_tex=False)
+        return document
+
+    def render(self, path: str) -> None:
+        self.mk_document().generate_pdf(path + self.name, clean_tex=False)
@@ -1,2 +1,4 @@
+from nongkrong.render.sound.cache import StemCache
 from nongkrong.render.sound.mix import *
+from nongkrong.render.sound.profile import DRAFT, FINAL, RenderProfile
 from nongkrong.render.sound.synthesis import *
\ No newline at end of file
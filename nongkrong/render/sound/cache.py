@@ -0,0 +1,133 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from mu.mel import mel
+
+"""This module implements a content addressed cache for rendered soundfiles (stems).
+
+The key of a stem is a hash of all events of the rendered cadence together with
+the configuration of the used SoundEngine. If a stem with the same key has
+already been rendered, the cached soundfile is linked (or copied) to the new
+destination instead of calling the sound engine again.
+"""
+
+
+class StemCache(object):
+    """Cache for soundfiles that are rendered by SoundEngine objects.
+
+    If the size of all cached soundfiles exceeds max_bytes, the least recently
+    used soundfiles get removed. The modification time of a cached file is
+    updated whenever it gets used.
+    """
+
+    def __init__(
+        self, directory: str = "output/cache/", max_bytes: int = 20 * 1024**3
+    ) -> None:
+        self.__directory = directory
+        self.__max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @property
+    def directory(self) -> str:
+        return self.__directory
+
+    @property
+    def max_bytes(self) -> int:
+        return self.__max_bytes
+
+    @staticmethod
+    def mk_key(cadence, sound_engine) -> str:
+        def pitch2str(pitch) -> str:
+            if pitch == mel.TheEmptyPitch:
+                return repr(pitch)
+            try:
+                return repr(tuple(sorted(repr(p) for p in pitch)))
+            except TypeError:
+                return repr(pitch)
+
+        data = hashlib.sha256()
+        data.update(repr(sound_engine.config).encode())
+        for event in cadence:
+            event_data = (pitch2str(event.pitch), event.delay, event.duration)
+            data.update(repr(tuple(str(d) for d in event_data)).encode())
+        return data.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, "{0}.wav".format(key))
+
+    def fetch(self, key: str, name: str) -> bool:
+        """Link cached soundfile to name.wav. Return False if there isn't any.
+
+        Another process can evict the cached soundfile at any time. If it
+        disappears while it gets fetched, it is treated as missing.
+        """
+        path = self.path(key)
+        target = "{0}.wav".format(name)
+        try:
+            os.utime(path)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(path, target)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                # for instance if the cache is on another file system
+                shutil.copyfile(path, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, name: str) -> None:
+        """Add soundfile name.wav to the cache (as a hard link if possible)."""
+        source = "{0}.wav".format(name)
+        if not os.path.exists(source):
+            return
+        # only a unique name is needed, os.link can't overwrite files
+        handle, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(handle)
+        os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            # for instance if the cache is on another file system
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, self.path(key))
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used soundfiles until the cache is small enough."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".wav"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        size = sum(f[1] for f in files)
+        for _, file_size, path in files:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+    def render(self, name: str, cadence, sound_engine) -> bool:
+        """Render cadence with sound_engine to name.wav if it isn't cached yet.
+
+        Return True if the soundfile has been found in the cache.
+        """
+        key = StemCache.mk_key(cadence, sound_engine)
+        if self.fetch(key, name):
+            return True
+        # the old soundfile could be a hard link to a cached soundfile
+        target = "{0}.wav".format(name)
+        if os.path.exists(target):
+            os.remove(target)
+        sound_engine(name, cadence)
+        self.store(key, name)
+        return False
@@ -1,12 +1,35 @@
 import os
 import shutil
+
+import numpy as np
 import sox
 
+from nongkrong.render.sound import process
+from nongkrong.render.sound import wav
+from nongkrong.render.sound.profile import FINAL
+from nongkrong.render.sound.profile import RenderProfile
+
+BLOCK_SIZE = 2**16
+
 
-def mix_mono(outputname, *inputname) -> None:
+def mix_mono(
+    outputname, *inputname, backend: str = "numpy", profile: RenderProfile = FINAL
+) -> None:
+    """Mix all input soundfiles to one mono soundfile.
+
+    backend can be 'numpy' (sum all channels of all inputs) or 'sox'. The
+    numpy backend writes the soundfile with the sample format of profile.
+    """
     outputname = "{0}.wav".format(outputname)
     inputname = tuple("{0}.wav".format(n) for n in inputname)
 
+    if backend == "numpy":
+        inputdata = tuple((n, 1, None, 0) for n in inputname)
+        mix_with_numpy(outputname, inputdata, 1, profile.rate, profile.sample_format)
+        return
+    elif backend != "sox":
+        raise ValueError("Unknown backend '{0}'.".format(backend))
+
     size = len(inputname)
     if size > 1:
         cbn = sox.Combiner()
@@ -18,14 +41,91 @@ def mix_mono(outputname, *inputname) -> None:
             f.write("")
 
 
-def mix_complex(outputname, *inputdata):
-    """one inputdata consist of three arguments:
+def mix_sections(outputname, *inputdata, profile: RenderProfile = FINAL) -> None:
+    """Mix soundfiles of consecutive sections to one mono soundfile.
 
-        (FILENAME, VOLUME, PAN)
+    One inputdata consist of (FILENAME, START) where START is the position of
+    the section in seconds. The release of a section overlaps with the beginning
+    of the following section.
+    """
+    outputname = "{0}.wav".format(outputname)
+    inputdata = tuple(("{0}.wav".format(n), 1, None, start) for n, start in inputdata)
+    mix_with_numpy(outputname, inputdata, 1, profile.rate, profile.sample_format)
+
+
+def mix_with_numpy(
+    outputname: str,
+    inputdata: tuple,
+    channels: int,
+    rate: int = 96000,
+    sample_format: str = "double",
+) -> None:
+    """Mix soundfiles block by block with numpy.
+
+    One inputdata consist of (FILENAME, VOLUME, PAN, START). The channels of
+    every input soundfile are summed. For a stereo output (channels == 2) the
+    left channel gets multiplied with 1 - PAN and the right channel with PAN.
+    For a mono output PAN is ignored. START is the delay in seconds. All input
+    soundfiles need to have the same sample rate (rate is only used if there
+    isn't any input soundfile).
+    """
+    readers = []
+    for name, volume, pan, start in inputdata:
+        reader = wav.WavReader(name)
+        if reader.frames:
+            readers.append((reader, volume, pan, int(round(start * reader.rate))))
+    rates = set(reader[0].rate for reader in readers)
+    if len(rates) > 1:
+        raise ValueError("Soundfiles with different sample rates can't be mixed.")
+    elif rates:
+        rate = rates.pop()
+    frames = max(
+        (offset + reader.frames for reader, _, _, offset in readers), default=0
+    )
+    with wav.WavWriter(outputname, rate, channels, sample_format) as writer:
+        for block_start in range(0, frames, BLOCK_SIZE):
+            block_end = min((block_start + BLOCK_SIZE, frames))
+            block = np.zeros((block_end - block_start, channels))
+            for reader, volume, pan, offset in readers:
+                start = max((block_start, offset))
+                end = min((block_end, offset + reader.frames))
+                if start < end:
+                    signal = reader.read(start - offset, end - start).sum(axis=1)
+                    signal = signal * volume
+                    position = slice(start - block_start, end - block_start)
+                    if channels == 2:
+                        block[position, 0] += signal * (1 - pan)
+                        block[position, 1] += signal * pan
+                    else:
+                        block[position, 0] += signal
+            writer.write(block)
+
+
+def mix_complex(
+    outputname,
+    *inputdata,
+    backend: str = "numpy",
+    profile: RenderProfile = FINAL,
+    timeout: float = None
+):
+    """one inputdata consist of four arguments:
+
+        (FILENAME, VOLUME, PAN, START)
+
+    backend can be 'numpy' or 'csound'. The soundfile is written with the
+    sample format (and for csound with the sample rate) of profile. timeout
+    is the maximum time in seconds for csound (None for no limit).
     """
 
     outputname = "{0}.wav".format(outputname)
 
+    if backend == "numpy":
+        inputdata = tuple(("{0}.wav".format(f[0]),) + tuple(f[1:]) for f in inputdata)
+        mix_with_numpy(outputname, inputdata, 2, profile.rate, profile.sample_format)
+        return
+    elif backend != "csound":
+        raise ValueError("Unknown backend '{0}'.".format(backend))
+
     def mk_orc():
         lines = (
             r"0dbfs=1",
@@ -47,25 +147,20 @@ def mix_complex(outputname, *inputdata):
             name, volume, pan, start = f
             name = "{0}.wav".format(name)
             pan0, pan1 = get_panning_arguments(pan)
-            duration = sox.file_info.duration(name)
+            duration = wav.SAMPLE_INDEX.duration(name)
             line = 'i1 {5} {0} "{1}" {2} {3} {4}'.format(
                 duration, name, volume, pan0, pan1, start
             )
             lines.append(line)
         return " \n".join(lines)
 
-    fname = "complexMix"
-    orc_name = "{0}.orc".format(fname)
-    sco_name = "{0}.sco".format(fname)
     orc = mk_orc()
     sco = mk_sco(inputdata)
-    for n, content in ((orc_name, orc), (sco_name, sco)):
-        with open(n, "w") as f:
-            f.write(content)
-
-    cmd0 = "csound --format=double -k 96000 -r 96000 -o {0} ".format(outputname)
-    cmd1 = "{0} {1}".format(orc_name, sco_name)
-    cmd = cmd0 + cmd1
-    os.system(cmd)
-    os.remove(orc_name)
-    os.remove(sco_name)
+    with process.workspace() as path:
+        orc_name = os.path.join(path, "complexMix.orc")
+        sco_name = os.path.join(path, "complexMix.sco")
+        for n, content in ((orc_name, orc), (sco_name, sco)):
+            with open(n, "w") as f:
+                f.write(content)
+        cmd = ("csound",) + profile.csound_flags
+        process.run(cmd + ("-o", outputname, orc_name, sco_name), timeout=timeout)
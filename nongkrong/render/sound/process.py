@@ -0,0 +1,81 @@
+import contextlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+"""This module offers helper to call external render programs (csound, pianoteq).
+
+Every call gets its own temporary working directory (workspace) to avoid
+collisions of auxiliary files between renders that are running at the same time.
+If the environment variable NONGKRONG_KEEP_WORKSPACE is set, workspaces won't be
+removed after the render has been finished (for debugging).
+"""
+
+
+class RenderError(Exception):
+    """Raised if an external render program fails.
+
+    returncode is None if the program couldn't be started or has been
+    killed after its timeout.
+    """
+
+    def __init__(
+        self, command: tuple, reason: str, returncode: int = None, stderr: str = ""
+    ) -> None:
+        self.command = tuple(command)
+        self.returncode = returncode
+        self.stderr = stderr
+        msg = "Command '{0}' failed: {1}".format(" ".join(self.command), reason)
+        if stderr:
+            msg += "\n{0}".format(stderr.strip())
+        super(RenderError, self).__init__(msg)
+
+
+@contextlib.contextmanager
+def workspace(prefix: str = "nongkrong_", keep: bool = None):
+    """Create temporary directory that gets removed afterwards.
+
+    If keep is True (or keep is None and NONGKRONG_KEEP_WORKSPACE is set),
+    the directory won't be removed.
+    """
+    if keep is None:
+        keep = bool(os.environ.get("NONGKRONG_KEEP_WORKSPACE"))
+    path = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield path
+    finally:
+        if keep:
+            print("Kept workspace {0}".format(path))
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def run(command: tuple, cwd: str = None, timeout: float = None) -> str:
+    """Run external program and return its standard output.
+
+    Raise RenderError if the program returns a non zero exit code or
+    if it hasn't finished after timeout seconds.
+    """
+    command = tuple(str(arg) for arg in command)
+    try:
+        process = subprocess.run(
+            command,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired as error:
+        stderr = error.stderr
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode(errors="replace")
+        reason = "timeout after {0} seconds.".format(timeout)
+        raise RenderError(command, reason, stderr=stderr or "")
+    except OSError as error:
+        raise RenderError(command, str(error))
+    if process.returncode != 0:
+        reason = "exit code {0}.".format(process.returncode)
+        raise RenderError(command, reason, process.returncode, process.stderr)
+    return process.stdout
@@ -0,0 +1,101 @@
+from nongkrong.render.sound import wav
+
+"""This module defines render profiles (sample rate, sample format, ...).
+
+A RenderProfile is passed from Score.render_sound through all sound engines
+and mixers, so that every rendered soundfile of one score is rendered with the
+same settings. FINAL is meant for the final result, DRAFT for fast previews
+with less disk usage.
+"""
+
+
+class RenderProfile(object):
+    """Settings for rendering soundfiles.
+
+    rate: sample rate in Hz
+    sample_format: one of the keys of wav.SAMPLE_FORMATS
+    grid_resolution: time in seconds between two ticks of rendered midi files
+    ksmps: audio samples per control period (for csound)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: int,
+        sample_format: str,
+        grid_resolution: float,
+        ksmps: int = 1,
+    ) -> None:
+        if sample_format not in wav.SAMPLE_FORMATS:
+            raise ValueError("Unknown sample format '{0}'.".format(sample_format))
+        if rate % ksmps:
+            raise ValueError("rate has to be divisible by ksmps.")
+        self.__name = name
+        self.__rate = rate
+        self.__sample_format = sample_format
+        self.__grid_resolution = grid_resolution
+        self.__ksmps = ksmps
+
+    def __repr__(self) -> str:
+        return "RenderProfile({0})".format(self.name)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, RenderProfile) and self.config == other.config
+
+    def __hash__(self) -> int:
+        return hash(self.config)
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def rate(self) -> int:
+        return self.__rate
+
+    @property
+    def sample_format(self) -> str:
+        return self.__sample_format
+
+    @property
+    def grid_resolution(self) -> float:
+        return self.__grid_resolution
+
+    @property
+    def ksmps(self) -> int:
+        return self.__ksmps
+
+    @property
+    def control_rate(self) -> int:
+        return self.rate // self.ksmps
+
+    @property
+    def bit_depth(self) -> int:
+        return wav.SAMPLE_FORMATS[self.sample_format][1]
+
+    @property
+    def pianoteq_bit_depth(self) -> int:
+        # pianoteq can't write 64 bit soundfiles
+        return min((self.bit_depth, 32))
+
+    @property
+    def csound_flags(self) -> tuple:
+        sample_format = {"int16": "short", "int24": "24bit", "int32": "long"}.get(
+            self.sample_format, self.sample_format
+        )
+        return (
+            "--format={0}".format(sample_format),
+            "-k",
+            self.control_rate,
+            "-r",
+            self.rate,
+        )
+
+    @property
+    def config(self) -> tuple:
+        """All settings that influence the rendered soundfile (for caching)."""
+        return (self.rate, self.sample_format, self.grid_resolution, self.ksmps)
+
+
+FINAL = RenderProfile("final", 96000, "double", 0.001)
+DRAFT = RenderProfile("draft", 44100, "float", 0.01, ksmps=10)
@@ -1 +1,6 @@
-from nongkrong.render.sound.synthesis.synthesis import PyteqEngine, SampleEngine
\ No newline at end of file
+from nongkrong.render.sound.synthesis.synthesis import (
+    PreviewEngine,
+    PyteqEngine,
+    SampleEngine,
+    SamplePlaybackEngine,
+)
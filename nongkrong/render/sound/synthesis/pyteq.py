@@ -6,12 +6,18 @@ from mu.rhy import rhy
 import abc
 import bisect
 import functools
+import heapq
 import itertools
+import math
 import operator
 import os
+import struct
 from typing import Optional
 
 import mido
+import numpy as np
+
+from nongkrong.render.sound import process
 
 __directory = os.path.dirname(os.path.abspath(__file__))
 with open(os.path.join(__directory, "", "12edo"), "r") as f:
@@ -33,8 +39,62 @@ def discard_pauses_and_tie_sequence(sequence):
     return tuple(new)
 
 
+def encode_variable_int(value: int) -> bytes:
+    """Encode integer as variable length quantity (like in midi files)."""
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def write_midi_file(name: str, messages, ticks_per_beat: int) -> None:
+    """Write midi file with one track while messages are still generated.
+
+    Every message gets encoded and written as soon as it arrives. The length of
+    the track chunk is written after the last message. Like mido, running
+    status is used for channel messages.
+    """
+    with open(name, "wb") as f:
+        f.write(b"MThd" + struct.pack(">Lhhh", 6, 0, 1, ticks_per_beat))
+        f.write(b"MTrk")
+        length_position = f.tell()
+        f.write(struct.pack(">L", 0))
+        track_length = 0
+        running_status_byte = None
+        for message in messages:
+            data = bytearray(encode_variable_int(message.time))
+            if message.is_meta:
+                data.extend(message.bytes())
+                running_status_byte = None
+            elif message.type == "sysex":
+                data.append(0xF0)
+                data.extend(encode_variable_int(len(message.data) + 1))
+                data.extend(message.data)
+                data.append(0xF7)
+                running_status_byte = None
+            else:
+                message_bytes = message.bytes()
+                status_byte = message_bytes[0]
+                if status_byte == running_status_byte:
+                    data.extend(message_bytes[1:])
+                else:
+                    data.extend(message_bytes)
+                if status_byte < 0xF0:
+                    running_status_byte = status_byte
+                else:
+                    running_status_byte = None
+            f.write(data)
+            track_length += len(data)
+        f.seek(length_position)
+        f.write(struct.pack(">L", track_length))
+
+
 class MidiTone(old.Tone):
     _init_args = {}
+    # (arg, control_number, lower_boundary, difference) for every control argument
+    _control_normalization = tuple([])
 
     def __init__(
         self,
@@ -52,22 +112,28 @@ class MidiTone(old.Tone):
         else:
             self.tuning = tuple([])
 
+    @staticmethod
+    def normalize_control_value(value, lower_boundary, difference) -> int:
+        return int(127 * ((value + lower_boundary) / difference))
+
     def control_messages(self, channel: int) -> tuple:
         """Generate control messages. Depending on specific channel."""
         messages = []
-        for arg in self._init_args:
+        for (
+            arg,
+            control_number,
+            lower_boundary,
+            difference,
+        ) in self._control_normalization:
             value = getattr(self, arg)
             if value is not None:
-                boundaries, control_number = self._init_args[arg]
-                difference = boundaries[1] - boundaries[0]
-                normalized = value + boundaries[0]
-                percent = normalized / difference
-                value = int(127 * percent)
                 message = mido.Message(
                     "control_change",
                     time=0,
                     control=control_number,
-                    value=value,
+                    value=MidiTone.normalize_control_value(
+                        value, lower_boundary, difference
+                    ),
                     channel=channel,
                 )
                 messages.append(message)
@@ -85,6 +151,13 @@ class SynthesizerMidiTone(abc.ABCMeta):
         "tuning",
     )
 
+    @staticmethod
+    def mk_control_normalization(init_args: dict) -> tuple:
+        return tuple(
+            (arg, control_number, boundaries[0], boundaries[1] - boundaries[0])
+            for arg, (boundaries, control_number) in init_args.items()
+        )
+
     def __new__(cls, name, bases, attrs):
         def auto_init(self, *args, **kwargs):
             arg_names = cls.tone_args + tuple(self._init_args.keys())
@@ -121,6 +194,9 @@ class SynthesizerMidiTone(abc.ABCMeta):
             )
 
         attrs["__init__"] = auto_init
+        attrs["_control_normalization"] = SynthesizerMidiTone.mk_control_normalization(
+            attrs.get("_init_args", {})
+        )
         return super(SynthesizerMidiTone, cls).__new__(cls, name, bases, attrs)
 
 
@@ -217,86 +293,369 @@ class PyteqTone(MidiTone, metaclass=SynthesizerMidiTone):
     }
 
 
+class Grid(object):
+    """Equidistant grid of time points, starting with 0.
+
+    The points of the grid are never stored. Times get mapped to the index of
+    the closest point by rounding.
+    """
+
+    def __init__(self, duration: float, resolution: float = 0.001):
+        self.__resolution = resolution
+        self.__size = int(duration // resolution)
+
+    def __repr__(self) -> str:
+        return "Grid({0} * {1})".format(self.__size, self.__resolution)
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def __getitem__(self, idx: int) -> float:
+        if idx < 0:
+            idx += self.__size
+        if idx < 0 or idx >= self.__size:
+            raise IndexError("grid index out of range")
+        return idx * self.__resolution
+
+    @property
+    def resolution(self) -> float:
+        return self.__resolution
+
+    def position(self, time: float) -> int:
+        """Return index of the closest point of the grid."""
+        idx = int(math.floor(float(time) / self.__resolution + 0.5))
+        return min((max((idx, 0)), self.__size - 1))
+
+
+class OverlapIndex(object):
+    """Index of simultaneously sounding tones in a sequence.
+
+    The index gets built by one sweep over the starts and endings of all tones
+    while a heap keeps track of the currently sounding tones. Two tones are
+    overlapping if one tone starts before the other one ends.
+    """
+
+    def __init__(self, sequence: tuple):
+        delays = tuple(tone.delay for tone in sequence)
+        self.__starts = tuple(itertools.accumulate((0,) + delays))[:-1]
+        self.__endings = tuple(
+            start + tone.duration for start, tone in zip(self.__starts, sequence)
+        )
+        self.__preceding, self.__following = OverlapIndex.sweep(
+            self.__starts, self.__endings
+        )
+
+    @staticmethod
+    def sweep(starts: tuple, endings: tuple) -> tuple:
+        """Return tones that are still sounding when a tone starts and tones
+        that start while a tone is still sounding."""
+        preceding = []
+        following = list([] for i in starts)
+        sounding_tones = []  # heap with (end, tone_index)
+        for tone_idx, start, end in zip(range(len(starts)), starts, endings):
+            while sounding_tones and sounding_tones[0][0] <= start:
+                heapq.heappop(sounding_tones)
+            simultan_tones = tuple(sorted(item[1] for item in sounding_tones))
+            for idx in simultan_tones:
+                following[idx].append(tone_idx)
+            preceding.append(simultan_tones)
+            heapq.heappush(sounding_tones, (end, tone_idx))
+        return tuple(preceding), tuple(tuple(f) for f in following)
+
+    def __len__(self) -> int:
+        return len(self.__starts)
+
+    @property
+    def starts(self) -> tuple:
+        return self.__starts
+
+    @property
+    def endings(self) -> tuple:
+        return self.__endings
+
+    def preceding(self, tone_idx: int) -> tuple:
+        """Return indices of earlier tones that are still sounding when tone starts."""
+        return self.__preceding[tone_idx]
+
+    def overlapping(self, tone_idx: int) -> tuple:
+        """Return indices of all tones that are overlapping with tone."""
+        return self.__preceding[tone_idx] + self.__following[tone_idx]
+
+    def sounding_at(self, time: float) -> tuple:
+        """Return indices of all tones that are sounding at the specific time."""
+        tone_idx = bisect.bisect_right(self.__starts, time) - 1
+        if tone_idx < 0:
+            return tuple([])
+        return tuple(
+            idx
+            for idx in self.__preceding[tone_idx] + (tone_idx,)
+            if self.__endings[idx] > time
+        )
+
+
+class TuningState(object):
+    """Keeps track of the current tuning of every midi key.
+
+    Retuning messages (MIDI Tuning Standard, real time single note tuning change)
+    are only generated for keys whose requested tuning differs from the last
+    tuning that has been sent for them.
+    """
+
+    max_keys_per_message = 127
+
+    def __init__(self):
+        self.__tuning_per_key = {}
+
+    def forget(self) -> None:
+        self.__tuning_per_key = {}
+
+    @staticmethod
+    def mk_message(key_tuning_pairs) -> mido.Message:
+        data = [127, 127, 8, 2, 0, len(key_tuning_pairs)]
+        for key, tuning in key_tuning_pairs:
+            data.extend((key, tuning[0], tuning[1], tuning[2]))
+        return mido.Message("sysex", data=data, time=0)
+
+    def retune(self, key_tuning_pairs, bulk: bool = False) -> tuple:
+        """Return retuning messages for all keys whose tuning is going to change.
+
+        If bulk is True, several keys are going to be retuned by one message.
+        Otherwise every key gets its own message.
+        """
+        changed = tuple(
+            (key, tuning)
+            for key, tuning in key_tuning_pairs
+            if self.__tuning_per_key.get(key) != tuning
+        )
+        self.__tuning_per_key.update(changed)
+        if bulk:
+            size = TuningState.max_keys_per_message
+            return tuple(
+                TuningState.mk_message(changed[idx : idx + size])
+                for idx in range(0, len(changed), size)
+            )
+        return tuple(TuningState.mk_message((pair,)) for pair in changed)
+
+
+class ControllerState(object):
+    """Keeps track of the current controller values of every midi channel.
+
+    Control change messages are only passed through if they change the value
+    of the controller on their channel.
+    """
+
+    def __init__(self):
+        self.__value_per_controller = {}
+
+    def forget(self) -> None:
+        self.__value_per_controller = {}
+
+    def update(self, messages) -> tuple:
+        """Return all control change messages that change a controller value."""
+        changed = []
+        for message in messages:
+            controller = (message.channel, message.control)
+            if self.__value_per_controller.get(controller) != message.value:
+                self.__value_per_controller[controller] = message.value
+                changed.append(message)
+        return tuple(changed)
+
+
+class VoiceAllocator(object):
+    """Distribute tones on midi channels.
+
+    Every tone gets the channel that has been free for the longest time (least
+    recently used). Only if all channels are still sounding, the channel whose
+    tone ends first gets shared with the new tone.
+    """
+
+    def __init__(self, grid_position_per_tone: tuple, channels: tuple):
+        self.__channels = tuple(channels)
+        self.__channel_per_tone = VoiceAllocator.allocate(
+            grid_position_per_tone, len(self.__channels)
+        )
+
+    @staticmethod
+    def allocate(grid_position_per_tone: tuple, amount_channels: int) -> tuple:
+        """Return index of the channel for every tone."""
+        # heap with (release_position, channel_idx)
+        free_channels = list(
+            (-1, channel_idx) for channel_idx in range(amount_channels)
+        )
+        sounding_channels = []  # heap with (end, tone_idx, channel_idx)
+        channel_per_tone = []
+        for tone_idx, start_end in enumerate(grid_position_per_tone):
+            start, end = start_end
+            while sounding_channels and sounding_channels[0][0] <= start:
+                release, _, channel_idx = heapq.heappop(sounding_channels)
+                heapq.heappush(free_channels, (release, channel_idx))
+            if free_channels:
+                channel_idx = heapq.heappop(free_channels)[1]
+            else:
+                channel_idx = heapq.heappop(sounding_channels)[2]
+            heapq.heappush(sounding_channels, (end, tone_idx, channel_idx))
+            channel_per_tone.append(channel_idx)
+        return tuple(channel_per_tone)
+
+    def __len__(self) -> int:
+        return len(self.__channel_per_tone)
+
+    def __getitem__(self, tone_idx: int) -> int:
+        """Return midi channel of tone."""
+        return self.__channels[self.__channel_per_tone[tone_idx]]
+
+    @property
+    def channel_per_tone(self) -> tuple:
+        """Index of the channel (in channels) for every tone."""
+        return self.__channel_per_tone
+
+    def tones_per_channel(self) -> tuple:
+        tones = tuple([] for channel in self.__channels)
+        for tone_idx, channel_idx in enumerate(self.__channel_per_tone):
+            tones[channel_idx].append(tone_idx)
+        return tuple(tuple(t) for t in tones)
+
+
 class MidiFile(object):
     maximum_cent_deviation = 1200
     maximum_pitch_bending = 16383
     maximum_pitch_bending_positive = 8191
     # for some weird reason pianoteq don't use channel 9
     available_channel = tuple(i for i in range(16) if i != 9)
+    bpm = 120
+    ticks_per_second = 1000
+    ticks_per_beat = int(ticks_per_second * 60 / bpm)
 
     def __init__(
-        self, sequence: tuple, available_midi_notes: tuple = tuple(range(128))
+        self,
+        sequence: tuple,
+        available_midi_notes: tuple = tuple(range(128)),
+        sparse_pitch_bends: bool = True,
+        backtrack_midi_keys: bool = False,
+        tuning_dump_positions: tuple = tuple([]),
+        grid_resolution: float = 0.001,
     ):
+        """If sparse_pitch_bends is True, pitch bending messages will only be
+        generated at those positions where the pitch bending of a channel changes.
+        Otherwise every channel gets a pitch bending message for every tick of the
+        grid (old behaviour).
+
+        If backtrack_midi_keys is True, the old backtracking solver will be used
+        to distribute tones on midi keys instead of the sweep line allocator.
+
+        Retuning messages are only sent for keys whose tuning changes. For every
+        time in tuning_dump_positions (for instance the beginning of a section)
+        the first tone that starts at or after this time retunes all its keys with
+        one bulk message.
+
+        The grid_resolution sets the time in seconds between two ticks of the
+        midi file. All events get quantized to this grid (1 ms for final renders,
+        5 - 10 ms are sufficient for drafts).
+        """
         sequence = discard_pauses_and_tie_sequence(sequence)
         filtered_sequence = tuple(t for t in sequence if t.pitch != mel.TheEmptyPitch)
-        gridsize = 0.001  # 1 milisecond
+        gridsize = grid_resolution
         self.__duration = float(sum(t.delay for t in sequence))
-        self.__grid = tuple(
-            i * gridsize for i in range(0, int(self.__duration // gridsize))
-        )
+        self.__grid = Grid(self.__duration, gridsize)
         self.__gridsize = gridsize
         self.__grid_position_per_tone = MidiFile.detect_grid_position(
             sequence, self.__grid, self.__duration
         )
         self.__amount_available_midi_notes = len(available_midi_notes)
         self.__sequence = sequence
-        self.__overlapping_dict = MidiFile.mk_overlapping_dict(filtered_sequence)
+        self.__overlap_index = OverlapIndex(filtered_sequence)
         self.__midi_keys_dict = MidiFile.mk_midi_key_dictionary(
             set(t.pitch for t in filtered_sequence),
             available_midi_notes,
             self.__amount_available_midi_notes,
         )
-        self.__keys = MidiFile.distribute_tones_on_midi_keys(
-            filtered_sequence,
-            self.__amount_available_midi_notes,
-            available_midi_notes,
-            self.__overlapping_dict,
-            self.__midi_keys_dict,
-        )
+        if backtrack_midi_keys:
+            self.__keys = MidiFile.distribute_tones_on_midi_keys(
+                filtered_sequence,
+                self.__amount_available_midi_notes,
+                available_midi_notes,
+                MidiFile.mk_overlapping_dict(self.__overlap_index),
+                self.__midi_keys_dict,
+            )
+        else:
+            self.__keys = MidiFile.allocate_midi_keys(
+                filtered_sequence,
+                available_midi_notes,
+                self.__midi_keys_dict,
+                self.__overlap_index,
+            )
         pitch_data = MidiFile.mk_pitch_sequence(filtered_sequence)
         self.__pitch_sequence = pitch_data[0]
         self.__tuning_sequence = pitch_data[1]
         self.__midi_pitch_dictionary = pitch_data[2]
+        self.__voice_allocator = VoiceAllocator(
+            self.__grid_position_per_tone, MidiFile.available_channel
+        )
         self.__control_messages = MidiFile.mk_control_messages_per_tone(
-            filtered_sequence
+            filtered_sequence, self.__voice_allocator, self.__grid_position_per_tone
         )
         self.__note_on_off_messages = MidiFile.mk_note_on_off_messages(
-            filtered_sequence, self.__keys
+            filtered_sequence, self.__keys, self.__voice_allocator
         )
         self.__pitch_bending_per_tone = MidiFile.detect_pitch_bending_per_tone(
-            filtered_sequence, self.__gridsize, self.__grid_position_per_tone
-        )
-        self.__pitch_bending_per_channel = MidiFile.distribute_pitch_bends_on_channels(
-            self.__pitch_bending_per_tone,
-            self.__grid,
-            self.__grid_position_per_tone,
+            filtered_sequence,
             self.__gridsize,
+            self.__grid_position_per_tone,
+            sparse_pitch_bends,
         )
+        if sparse_pitch_bends:
+            pitch_bending = MidiFile.distribute_pitch_bend_changes_on_channels(
+                self.__pitch_bending_per_tone,
+                self.__grid_position_per_tone,
+                self.__voice_allocator.channel_per_tone,
+            )
+        else:
+            pitch_bending = MidiFile.distribute_pitch_bends_on_channels(
+                self.__pitch_bending_per_tone,
+                self.__grid,
+                self.__grid_position_per_tone,
+                self.__voice_allocator.channel_per_tone,
+            )
+        self.__pitch_bending_per_channel = pitch_bending
         self.__tuning_messages = MidiFile.mk_tuning_messages(
             filtered_sequence,
             self.__keys,
             available_midi_notes,
-            self.__overlapping_dict,
+            self.__overlap_index,
             self.__midi_pitch_dictionary,
-        )
-        self.__messages = self.mk_complete_messages(
-            filtered_sequence,
-            self.__gridsize,
-            self.__grid,
             self.__grid_position_per_tone,
-            self.__control_messages,
-            self.__note_on_off_messages,
-            self.__pitch_bending_per_channel,
-            self.__tuning_messages,
+            # absolute ticks (the starts of the overlap index ignore rests)
+            tuple(
+                self.__grid.position(position)
+                for position in tuning_dump_positions
+                if position < self.__duration
+            ),
         )
-        self.__miditrack = MidiFile.mk_midi_track(self.__messages)
+        self.__sparse_pitch_bends = sparse_pitch_bends
+        self.__filtered_sequence = filtered_sequence
+        self.__miditrack = None
 
     @staticmethod
     def mk_tuning_messages(
-        sequence, keys, available_midi_notes, overlapping_dict, midi_pitch_dict
+        sequence,
+        keys,
+        available_midi_notes,
+        overlap_index,
+        midi_pitch_dict,
+        grid_position_per_tone,
+        tuning_dump_ticks: tuple = tuple([]),
     ) -> tuple:
+        """Return retuning messages for every tone.
+
+        Every tone retunes its own key and all keys that aren't used by any other
+        sounding tone. Keys that already have the expected tuning won't be
+        retuned again. At the first tone that starts at or after any tick of
+        tuning_dump_ticks all keys of the tone get retuned by one bulk message,
+        no matter what their prior tuning was.
+        """
+
         def check_for_available_midi_notes(
-            available_midi_notes, overlapping_dict, keys, tone_index
+            available_midi_notes, overlap_index, keys, tone_index
         ) -> tuple:
             """Return tuple with two elements:
 
@@ -304,14 +663,14 @@ class MidiFile(object):
             2. remaining available midi numbers for retuning
             """
             played_key = keys[tone_index]
-            busy_keys = tuple(keys[idx] for idx in tuple(overlapping_dict[tone_index]))
+            busy_keys = tuple(keys[idx] for idx in overlap_index.preceding(tone_index))
             busy_keys += (played_key,)
             remaining_keys = tuple(
                 key for key in available_midi_notes if key not in busy_keys
             )
             return (played_key, remaining_keys)
 
-        def mk_tuning_messages_for_tone(tone, local_midi_notes) -> tuple:
+        def mk_key_tuning_pairs_for_tone(tone, local_midi_notes) -> tuple:
             if tone.pitch != mel.TheEmptyPitch:
                 midi_pitch = midi_pitch_dict[tone.pitch]
                 played_midi_note, remaining_midi_notes = local_midi_notes
@@ -329,152 +688,201 @@ class MidiFile(object):
                 midi_tuning = tuple(midi_pitch_dict[pitch] for pitch in tuning)
                 key_tuning_pairs = tuple(zip(sorted(remaining_midi_notes), midi_tuning))
                 key_tuning_pairs = ((played_midi_note, midi_pitch),) + key_tuning_pairs
-                messages = []
-                for key, tuning in key_tuning_pairs:
-                    msg = mido.Message(
-                        "sysex",
-                        data=(
-                            127,
-                            127,
-                            8,
-                            2,
-                            0,
-                            1,
-                            key,
-                            tuning[0],
-                            tuning[1],
-                            tuning[2],
-                        ),
-                        time=0,
-                    )
-                    messages.append(msg)
-                return tuple(messages)
+                return key_tuning_pairs
             else:
                 return tuple([])
 
         available_midi_notes_per_tone = tuple(
-            check_for_available_midi_notes(
-                available_midi_notes, overlapping_dict, keys, i
-            )
+            check_for_available_midi_notes(available_midi_notes, overlap_index, keys, i)
             for i in range(len(sequence))
         )
-        tuning_messages_per_tone = tuple(
-            mk_tuning_messages_for_tone(tone, local_midi_notes)
+        key_tuning_pairs_per_tone = tuple(
+            mk_key_tuning_pairs_for_tone(tone, local_midi_notes)
             for tone, local_midi_notes in zip(sequence, available_midi_notes_per_tone)
         )
-        return tuning_messages_per_tone
+
+        # tuning messages of tones that start at the same tick are
+        # sent in reversed order (see mk_complete_messages)
+        tuning_state = TuningState()
+        tuning_dump_ticks = list(sorted(tuning_dump_ticks, reverse=True))
+        tuning_messages_per_tone = [tuple([]) for tone in sequence]
+        for tone_idx in sorted(
+            range(len(sequence)), key=lambda idx: (grid_position_per_tone[idx][0], -idx)
+        ):
+            is_dump = False
+            while (
+                tuning_dump_ticks
+                and tuning_dump_ticks[-1] <= grid_position_per_tone[tone_idx][0]
+            ):
+                tuning_dump_ticks.pop()
+                is_dump = True
+            if is_dump:
+                tuning_state.forget()
+            tuning_messages_per_tone[tone_idx] = tuning_state.retune(
+                key_tuning_pairs_per_tone[tone_idx], is_dump
+            )
+        return tuple(tuning_messages_per_tone)
 
     @staticmethod
     def distribute_pitch_bends_on_channels(
-        pitch_bends_per_tone, grid, grid_position_per_tone, gridsize
+        pitch_bends_per_tone, grid, grid_position_per_tone, channel_per_tone
     ) -> tuple:
-        channels = itertools.cycle(range(len(MidiFile.available_channel)))
-        pitches_per_channels = list(
-            list(0 for j in range(len(grid))) for i in MidiFile.available_channel
-        )
-        for position, pitch_bends in zip(grid_position_per_tone, pitch_bends_per_tone):
-            channel = next(channels)
-            start = position[0]
-            end = position[1]
-            pitches_per_channels[channel][start:end] = pitch_bends
+        """Return pitch bending message for every channel and every tick.
+
+        channel_per_tone contains the index of the channel of every tone (see
+        VoiceAllocator). Later tones overwrite earlier tones that are still
+        sounding on the same channel.
+        """
+        cents_per_channel = np.zeros((len(MidiFile.available_channel), len(grid)))
+        for position, pitch_bends, channel_idx in zip(
+            grid_position_per_tone, pitch_bends_per_tone, channel_per_tone
+        ):
+            cents_per_channel[channel_idx, position[0] : position[1]] = pitch_bends
+        midi_pitch_per_channel = MidiFile.convert_cents2pitch_bends(cents_per_channel)
         # transform to pitch_bending midi - messages
-        first = True
         pitch_bending_messages = []
-        total_range = MidiFile.maximum_cent_deviation * 2
-        warn = Warning("Maximum pitch bending is one octave up or down!")
-        standardmessage0 = tuple(
-            mido.Message("pitchwheel", channel=channel_number, pitch=0, time=0)
-            for channel_number in MidiFile.available_channel
-        )
-        standardmessage1 = tuple(
-            mido.Message("pitchwheel", channel=channel_number, pitch=0, time=1)
-            for channel_number in MidiFile.available_channel
-        )
-        for channel_number, channel in zip(
-            reversed(MidiFile.available_channel), reversed(pitches_per_channels)
-        ):
+        for channel_idx, channel_number in enumerate(MidiFile.available_channel):
+            # the messages of the last channel get a delay of one tick
+            time = int(channel_idx == len(MidiFile.available_channel) - 1)
+            messages_per_pitch = {}
             pitch_bending_messages_sub_channel = []
-            for cent_deviation in channel:
-                if first is True:
-                    time = 1
-                else:
-                    time = 0
-                if cent_deviation != 0:
-                    pitch_percent = (
-                        cent_deviation + MidiFile.maximum_cent_deviation
-                    ) / total_range
-                    if pitch_percent > 1:
-                        pitch_percent = 1
-                        raise warn
-                    if pitch_percent < 0:
-                        pitch_percent = 0
-                        raise warn
-                    midi_pitch = int(MidiFile.maximum_pitch_bending * pitch_percent)
-                    midi_pitch -= MidiFile.maximum_pitch_bending_positive
-                    msg = mido.Message(
+            for midi_pitch in midi_pitch_per_channel[channel_idx].tolist():
+                if midi_pitch not in messages_per_pitch:
+                    messages_per_pitch[midi_pitch] = mido.Message(
                         "pitchwheel",
                         channel=channel_number,
                         pitch=midi_pitch,
                         time=time,
                     )
-                else:
-                    if time == 0:
-                        msg = standardmessage0[
-                            MidiFile.available_channel.index(channel_number)
-                        ]
-                    else:
-                        msg = standardmessage1[
-                            MidiFile.available_channel.index(channel_number)
-                        ]
-                pitch_bending_messages_sub_channel.append(msg)
+                pitch_bending_messages_sub_channel.append(
+                    messages_per_pitch[midi_pitch]
+                )
             pitch_bending_messages.append(pitch_bending_messages_sub_channel)
-            first = False
-        pitch_bending_messages = tuple(reversed(pitch_bending_messages))
-        return pitch_bending_messages
+        return tuple(pitch_bending_messages)
+
+    @staticmethod
+    def convert_cents2pitch_bend(cent_deviation) -> int:
+        if cent_deviation == 0:
+            return 0
+        total_range = MidiFile.maximum_cent_deviation * 2
+        pitch_percent = (cent_deviation + MidiFile.maximum_cent_deviation) / total_range
+        if pitch_percent > 1 or pitch_percent < 0:
+            raise Warning("Maximum pitch bending is one octave up or down!")
+        midi_pitch = int(MidiFile.maximum_pitch_bending * pitch_percent)
+        return midi_pitch - MidiFile.maximum_pitch_bending_positive
+
+    @staticmethod
+    def convert_cents2pitch_bends(cent_deviations) -> np.ndarray:
+        """Vectorized version of convert_cents2pitch_bend."""
+        cent_deviations = np.asarray(cent_deviations, dtype=float)
+        total_range = MidiFile.maximum_cent_deviation * 2
+        pitch_percent = (
+            cent_deviations + MidiFile.maximum_cent_deviation
+        ) / total_range
+        if np.any(pitch_percent > 1) or np.any(pitch_percent < 0):
+            raise Warning("Maximum pitch bending is one octave up or down!")
+        midi_pitch = (MidiFile.maximum_pitch_bending * pitch_percent).astype(int)
+        midi_pitch -= MidiFile.maximum_pitch_bending_positive
+        midi_pitch[cent_deviations == 0] = 0
+        return midi_pitch
+
+    @staticmethod
+    def distribute_pitch_bend_changes_on_channels(
+        pitch_bends_per_tone, grid_position_per_tone, channel_per_tone
+    ) -> tuple:
+        """Return tuple that contains the pitch bending change points per channel.
+
+        Every channel is represented by a tuple of (grid_position, midi_pitch) pairs.
+        A pair only exists where the pitch bending value of the channel changes.
+        Tones without any pitch bending are expected to be None. Like in
+        distribute_pitch_bends_on_channels later tones overwrite earlier tones
+        that are still sounding on the same channel.
+
+        The pitch bending of a channel won't be reset after a tone ends. It only
+        gets reset when the next tone on the same channel starts and needs a
+        different value, so that the release of the last tone keeps its pitch.
+        """
+        # every channel is a sorted list of non-overlapping pieces
+        # (start, end, position of the first pitch bend, pitch bends)
+        pieces_per_channel = list([] for i in MidiFile.available_channel)
+        for position, pitch_bends, channel_idx in zip(
+            grid_position_per_tone, pitch_bends_per_tone, channel_per_tone
+        ):
+            pieces = pieces_per_channel[channel_idx]
+            start, end = position
+            if start == end:
+                continue
+            overwritten = []
+            while pieces and pieces[-1][1] > start:
+                piece = pieces.pop()
+                if piece[1] > end:
+                    overwritten.append((max(piece[0], end),) + piece[1:])
+                if piece[0] < start:
+                    pieces.append((piece[0], start) + piece[2:])
+            if pitch_bends is not None:
+                pitch_bends = MidiFile.convert_cents2pitch_bends(pitch_bends)
+            pieces.append((start, end, start, pitch_bends))
+            pieces.extend(reversed(overwritten))
+
+        pitch_bend_changes_per_channel = []
+        for pieces in pieces_per_channel:
+            changes = []
+            current = 0
+            for start, end, origin, pitch_bends in pieces:
+                if pitch_bends is None:
+                    values = np.zeros(1, dtype=int)
+                else:
+                    values = pitch_bends[start - origin : end - origin]
+                previous = np.concatenate(((current,), values[:-1]))
+                for idx in np.flatnonzero(values != previous):
+                    changes.append((start + int(idx), int(values[idx])))
+                current = int(values[-1])
+            pitch_bend_changes_per_channel.append(tuple(changes))
+        return tuple(pitch_bend_changes_per_channel)
 
     @staticmethod
     def detect_pitch_bending_per_tone(
-        sequence, gridsize, grid_position_per_tone
+        sequence, gridsize, grid_position_per_tone, skip_unbended_tones=False
     ) -> tuple:
-        """Return tuple filled with tuples that contain cent deviation per step."""
+        """Return tuple filled with arrays that contain cent deviation per step.
+
+        If skip_unbended_tones is True, tones without glissando and vibrato
+        are represented by None instead of a tuple filled with zeros.
+        """
 
         def mk_interpolation(obj, size):
+            interpolation = np.zeros(size)
             if obj:
-                obj = list(obj.interpolate(gridsize))
-            else:
-                obj = []
-            while len(obj) > size:
-                obj = obj[:-1]
-            while len(obj) < size:
-                obj.append(0)
-            return obj
+                values = np.asarray(obj.interpolate(gridsize), dtype=float)[:size]
+                interpolation[: len(values)] = values
+            return interpolation
 
         pitch_bending = []
         for tone, start_end in zip(sequence, grid_position_per_tone):
+            if skip_unbended_tones and not tone.glissando and not tone.vibrato:
+                pitch_bending.append(None)
+                continue
             size = start_end[1] - start_end[0]
             glissando = mk_interpolation(tone.glissando, size)
             vibrato = mk_interpolation(tone.vibrato, size)
-            resulting_cents = tuple(a + b for a, b in zip(glissando, vibrato))
-            pitch_bending.append(resulting_cents)
+            pitch_bending.append(glissando + vibrato)
         return tuple(pitch_bending)
 
     @staticmethod
-    def mk_note_on_off_messages(sequence, keys) -> tuple:
+    def mk_note_on_off_messages(sequence, keys, voice_allocator) -> tuple:
         """Generate Note on / off messages for every tone.
 
         Resulting tuple has the form:
         ((note_on0, note_off0), (note_on1, note_off1), ...)
         """
         assert len(sequence) == len(keys)
-        channels = itertools.cycle(MidiFile.available_channel)
         messages = []
-        for tone, key in zip(sequence, keys):
+        for tone, key, chnl in zip(sequence, keys, voice_allocator):
             if tone.pitch != mel.TheEmptyPitch:
                 if tone.volume:
                     velocity = int((tone.volume / 1) * 127)
                 else:
                     velocity = 64
-                chnl = next(channels)
                 msg0 = mido.Message(
                     "note_on", note=key, velocity=velocity, time=0, channel=chnl
                 )
@@ -485,27 +893,13 @@ class MidiFile(object):
         return tuple(messages)
 
     @staticmethod
-    def detect_grid_position(sequence, grid, duration):
-        def find_closest_point(points, time):
-            pos = bisect.bisect_right(points, time)
-            try:
-                return min(
-                    (
-                        (abs(time - points[pos]), pos),
-                        (abs(time - points[pos - 1]), pos - 1),
-                    ),
-                    key=operator.itemgetter(0),
-                )[1]
-            except IndexError:
-                # if pos is len(points) + 1
-                return pos - 1
-
+    def detect_grid_position(sequence, grid: Grid, duration):
         delays = tuple(tone.delay for tone in sequence)
         starts = tuple(itertools.accumulate((0,) + delays))[:-1]
         durations = tuple(tone.duration for tone in sequence)
         endings = tuple(s + d for s, d in zip(starts, durations))
-        start_points = tuple(find_closest_point(grid, s) for s in starts)
-        end_points = tuple(find_closest_point(grid, e) for e in endings)
+        start_points = tuple(grid.position(s) for s in starts)
+        end_points = tuple(grid.position(e) for e in endings)
         zipped = tuple(zip(start_points, end_points))
         return tuple(
             start_end
@@ -518,43 +912,72 @@ class MidiFile(object):
         return tuple(self.__sequence)
 
     @staticmethod
-    def mk_control_messages_per_tone(sequence) -> tuple:
-        channels = itertools.cycle(range(16))
-        return tuple(tone.control_messages(next(channels)) for tone in sequence)
+    def mk_control_messages_per_tone(
+        sequence, voice_allocator, grid_position_per_tone
+    ) -> tuple:
+        """Return control messages of every tone.
+
+        Messages that won't change the current value of the controller on the
+        channel of the tone are discarded.
+        """
+        # control messages of tones that start at the same tick are
+        # sent in reversed order (see mk_complete_messages)
+        controller_state = ControllerState()
+        control_messages_per_tone = [tuple([]) for tone in sequence]
+        for tone_idx in sorted(
+            range(len(sequence)), key=lambda idx: (grid_position_per_tone[idx][0], -idx)
+        ):
+            control_messages_per_tone[tone_idx] = controller_state.update(
+                sequence[tone_idx].control_messages(voice_allocator[tone_idx])
+            )
+        return tuple(control_messages_per_tone)
+
+    @staticmethod
+    def mk_header_messages(grid_resolution: float = 0.001) -> tuple:
+        messages = [mido.MetaMessage("instrument_name", name="Acoustic Grand Piano")]
+        if grid_resolution != 1 / MidiFile.ticks_per_second:
+            tempo = int(round(grid_resolution * MidiFile.ticks_per_beat * 1000000))
+            messages.append(mido.MetaMessage("set_tempo", tempo=tempo))
+        for i in MidiFile.available_channel:
+            messages.append(
+                mido.Message("program_change", program=0, time=0, channel=i)
+            )
+        return tuple(messages)
+
+    @staticmethod
+    def mk_delta_messages(
+        events, amount_ticks: int = 0, grid_resolution: float = 0.001
+    ):
+        """Yield all messages of a midi track from (absolute_tick, message) pairs.
+
+        The resulting messages have delta times. One tick lasts grid_resolution
+        seconds. The track won't end before amount_ticks.
+        """
+        for message in MidiFile.mk_header_messages(grid_resolution):
+            yield message
+        last_tick = 0
+        for tick, message in events:
+            yield message.copy(time=tick - last_tick)
+            last_tick = tick
+        end_of_track = max((amount_ticks - last_tick, 0))
+        yield mido.MetaMessage("end_of_track", time=end_of_track)
 
     @staticmethod
-    def mk_midi_track(messages) -> mido.MidiFile:
+    def mk_midi_track(
+        events, amount_ticks: int = 0, grid_resolution: float = 0.001
+    ) -> mido.MidiFile:
+        """Make midi file from (absolute_tick, message) pairs."""
         mid = mido.MidiFile(type=0)
-        bpm = 120
-        ticks_per_second = 1000
-        ticks_per_minute = ticks_per_second * 60
-        ticks_per_beat = int(ticks_per_minute / bpm)
-        mid.ticks_per_beat = ticks_per_beat
+        mid.ticks_per_beat = MidiFile.ticks_per_beat
         track = mido.MidiTrack()
         mid.tracks.append(track)
-        track.append(mido.MetaMessage("instrument_name", name="Acoustic Grand Piano"))
-        for i in MidiFile.available_channel:
-            track.append(mido.Message("program_change", program=0, time=0, channel=i))
-        for message in messages:
-            track.append(message)
+        track.extend(MidiFile.mk_delta_messages(events, amount_ticks, grid_resolution))
         return mid
 
     @staticmethod
-    def mk_overlapping_dict(sequence) -> dict:
-        delays = tuple(t.delay for t in sequence)
-        absolute_delays = tuple(
-            b - a for a, b in zip(delays, delays[1:] + (sum(delays),))
-        )
-        overlapping_dict = {i: [] for i, t in enumerate(sequence)}
-        for i, tone in enumerate(sequence):
-            if tone.delay < tone.duration:
-                ending = delays[i] + tone.duration
-                for j, abs_delay in enumerate(absolute_delays[i + 1 :]):
-                    if abs_delay < ending:
-                        overlapping_dict[i + j + 1].append(i)
-                    else:
-                        break
-        return overlapping_dict
+    def mk_overlapping_dict(overlap_index: OverlapIndex) -> dict:
+        """Return dict with all earlier tones that are still sounding per tone."""
+        return {i: list(overlap_index.preceding(i)) for i in range(len(overlap_index))}
 
     @staticmethod
     def distribute_tones_on_midi_keys(
@@ -592,6 +1015,57 @@ class MidiFile(object):
         converted_keys = convert_keys(keys)
         return tuple(available_midi_notes[key] for key in converted_keys)
 
+    @staticmethod
+    def allocate_midi_keys(
+        sequence, available_midi_notes, midi_keys_dict, overlap_index: OverlapIndex
+    ) -> tuple:
+        """Distribute tones on midi keys with a sweep line over starts and endings.
+
+        Every tone gets the best ranked key (according to midi_keys_dict) that
+        isn't used by any other tone that is still sounding when the tone starts.
+        Free keys are organised in one priority queue per pitch that is ordered by
+        the ranking of the respective pitch. Keys that turn out to be busy get
+        parked until the tone that occupies them ends.
+        """
+        rank_per_pitch = {
+            pitch: {key: rank for rank, key in enumerate(ranking)}
+            for pitch, ranking in midi_keys_dict.items()
+        }
+        # sorted lists already fulfill the heap invariant
+        free_ranks_per_pitch = {
+            pitch: list(range(len(ranking)))
+            for pitch, ranking in midi_keys_dict.items()
+        }
+        parking_pitches_per_key = {}
+        busy_keys = set([])
+        sounding_tones = []  # heap with (end, tone_index, key)
+        keys = []
+        for tone_idx, tone, start, end in zip(
+            range(len(sequence)), sequence, overlap_index.starts, overlap_index.endings
+        ):
+            while sounding_tones and sounding_tones[0][0] <= start:
+                key = heapq.heappop(sounding_tones)[2]
+                busy_keys.discard(key)
+                for pitch in parking_pitches_per_key.pop(key, tuple([])):
+                    heapq.heappush(
+                        free_ranks_per_pitch[pitch], rank_per_pitch[pitch][key]
+                    )
+
+            ranking = midi_keys_dict[tone.pitch]
+            free_ranks = free_ranks_per_pitch[tone.pitch]
+            while free_ranks:
+                key = ranking[heapq.heappop(free_ranks)]
+                parking_pitches_per_key.setdefault(key, []).append(tone.pitch)
+                if key not in busy_keys:
+                    break
+            else:
+                raise ValueError("No solution found! Too many simultan tones.")
+
+            busy_keys.add(key)
+            heapq.heappush(sounding_tones, (end, tone_idx, key))
+            keys.append(available_midi_notes[key])
+        return tuple(keys)
+
     @staticmethod
     def mk_pitch_sequence(sequence) -> "pitch_sequence, tuning_sequence, midi_dict":
         pitch_sequence = tuple(t.pitch for t in sequence)
@@ -630,24 +1104,65 @@ class MidiFile(object):
         available_frequencies = tuple(_12edo_freq[idx] for idx in available_midi_notes)
         return {pitch: evaluate_rating(pitch) for pitch in pitches}
 
+    @staticmethod
+    def mk_pitch_bend_stream_by_grid(pitch_bending_per_channel):
+        """Yield (sort_key, message) pairs from dense pitch bending messages.
+
+        Every message of the last channel has a delay of one tick and therefore
+        belongs already to the next tick (see distribute_pitch_bends_on_channels).
+        """
+        for tick, messages in enumerate(zip(*pitch_bending_per_channel)):
+            for message in messages[:-1]:
+                yield ((tick, 1, message.channel, 0), message)
+            yield ((tick + 1, -1, messages[-1].channel, 0), messages[-1])
+
+    @staticmethod
+    def mk_pitch_bend_stream_by_change_points(pitch_bend_changes_per_channel):
+        """Yield (sort_key, message) pairs from pitch bending change points.
+
+        A change point that happens at the start of a tone has to reach the
+        channel before the note on message of the tone, therefore pitch bending
+        changes are sorted before all other messages of the same tick.
+        """
+        events = []
+        for channel_number, changes in zip(
+            MidiFile.available_channel, pitch_bend_changes_per_channel
+        ):
+            for position, midi_pitch in changes:
+                events.append(((position, -1, channel_number, 0), midi_pitch))
+        events.sort(key=operator.itemgetter(0))
+        for key, midi_pitch in events:
+            message = mido.Message("pitchwheel", channel=key[2], pitch=midi_pitch)
+            yield (key, message)
+
     @staticmethod
     def mk_complete_messages(
         filtered_sequence,
-        gridsize,
-        grid,
         grid_position_per_tone,
         control_messages,
         note_on_off_messages,
-        pitch_bending_per_channel,
+        pitch_bend_stream,
         tuning_messages,
-    ) -> tuple:
+    ):
+        """Merge time sorted streams of all messages to one stream.
+
+        There is one stream for note on / off messages, one for control
+        messages, one for tuning messages and one for pitch bending messages.
+        Every stream yields (sort_key, message) pairs, where the first element
+        of sort_key is the absolute tick of the message. Messages that happen
+        at the same tick are played first by the last tone (tuning, control and
+        then note on). Pitch bending change points come before all of them,
+        dense pitch bending messages after all of them.
+
+        Return iterator that yields (absolute_tick, message) pairs.
+        """
         length_seq = len(filtered_sequence)
         assert length_seq == len(control_messages)
         assert length_seq == len(note_on_off_messages)
         assert length_seq == len(tuning_messages)
-        messages_per_tick = list(zip(*reversed(pitch_bending_per_channel)))
-        messages_per_tick = [list(s) for s in messages_per_tick]
-        for note_on_off, control, tuning, grid_position in zip(
+        note_on_off_events, control_events, tuning_events = [], [], []
+        for tone_idx, note_on_off, control, tuning, grid_position in zip(
+            range(length_seq),
             note_on_off_messages,
             control_messages,
             tuning_messages,
@@ -655,36 +1170,112 @@ class MidiFile(object):
         ):
             note_on, note_off = note_on_off
             start, stop = grid_position
-            messages_per_tick[start].append(note_on)
-            messages_per_tick[start].extend(control)
-            messages_per_tick[start].extend(tuning)
-            messages_per_tick[stop].append(note_off)
-        messages_per_tick = tuple(tuple(reversed(tick)) for tick in messages_per_tick)
-        return tuple(item for sublist in messages_per_tick for item in sublist)
+            amount_control = len(control)
+            amount_messages = 1 + amount_control + len(tuning)
+            note_on_off_events.append(((start, 0, -tone_idx, 0), note_on))
+            note_on_off_events.append(
+                ((stop, 0, -tone_idx, -amount_messages), note_off)
+            )
+            for position, message in enumerate(control):
+                control_events.append(((start, 0, -tone_idx, -1 - position), message))
+            for position, message in enumerate(tuning):
+                tuning_events.append(
+                    ((start, 0, -tone_idx, -1 - amount_control - position), message)
+                )
+        streams = (note_on_off_events, control_events, tuning_events)
+        for events in streams:
+            events.sort(key=operator.itemgetter(0))
+        merged = heapq.merge(*streams, pitch_bend_stream, key=operator.itemgetter(0))
+        return ((key[0], message) for key, message in merged)
+
+    def _mk_absolute_events(self):
+        if self.__sparse_pitch_bends:
+            pitch_bend_stream = MidiFile.mk_pitch_bend_stream_by_change_points(
+                self.__pitch_bending_per_channel
+            )
+        else:
+            pitch_bend_stream = MidiFile.mk_pitch_bend_stream_by_grid(
+                self.__pitch_bending_per_channel
+            )
+        return MidiFile.mk_complete_messages(
+            self.__filtered_sequence,
+            self.__grid_position_per_tone,
+            self.__control_messages,
+            self.__note_on_off_messages,
+            pitch_bend_stream,
+            self.__tuning_messages,
+        )
+
+    def iter_events(self):
+        """Return iterator over all midi messages of the track.
+
+        The messages are generated on the fly and have delta times. The same
+        stream can be passed to a file, a midi port or a test.
+        """
+        return MidiFile.mk_delta_messages(
+            self._mk_absolute_events(), len(self.__grid), self.__gridsize
+        )
 
     @property
     def miditrack(self) -> mido.MidiFile:
+        if self.__miditrack is None:
+            self.__miditrack = MidiFile.mk_midi_track(
+                self._mk_absolute_events(), len(self.__grid), self.__gridsize
+            )
         return self.__miditrack
 
     def export(self, name: str = "test.mid") -> None:
         """save content of object to midi-file."""
-        self.__miditrack.save(name)
+        write_midi_file(name, self.iter_events(), MidiFile.ticks_per_beat)
 
 
 class Pianoteq(MidiFile):
     def __init__(
-        self, sequence: tuple, available_midi_notes: tuple = tuple(range(128))
+        self,
+        sequence: tuple,
+        available_midi_notes: tuple = tuple(range(128)),
+        sparse_pitch_bends: bool = True,
+        backtrack_midi_keys: bool = False,
+        tuning_dump_positions: tuple = tuple([]),
+        grid_resolution: float = 0.001,
     ):
-        MidiFile.__init__(self, sequence, available_midi_notes)
+        MidiFile.__init__(
+            self,
+            sequence,
+            available_midi_notes,
+            sparse_pitch_bends,
+            backtrack_midi_keys,
+            tuning_dump_positions,
+            grid_resolution,
+        )
+
+    def export2wav(
+        self,
+        name,
+        nchnls=1,
+        preset=None,
+        fxp=None,
+        timeout=None,
+        rate=96000,
+        bit_depth=32,
+    ):
+        """Render midi file with Pianoteq to the soundfile NAME.wav.
 
-    def export2wav(self, name, nchnls=1, preset=None, fxp=None):
-        self.export("{0}.mid".format(name))
-        cmd = "./pianoteq --rate 96000 --bit-depth 32 --midimapping complete "
+        The pianoteq executable is expected in the current working directory.
+        The midi file is written to a workspace, which is also the working
+        directory of Pianoteq.
+        """
+        cmd = [os.path.abspath("pianoteq"), "--rate", str(rate)]
+        cmd.extend(("--bit-depth", str(bit_depth), "--midimapping", "complete"))
         if nchnls == 1:
-            cmd += "--mono "
+            cmd.append("--mono")
         if preset is not None:
-            cmd += "--preset {0} ".format(preset)
+            cmd.extend(("--preset", preset))
         if fxp is not None:
-            cmd += "--fxp {0} ".format(fxp)
-        cmd += "--midi {0}.mid --wav {0}.wav".format(name)
-        os.system(cmd)
+            cmd.extend(("--fxp", os.path.abspath(fxp)))
+        with process.workspace() as path:
+            midi_name = os.path.join(path, "pianoteq.mid")
+            self.export(midi_name)
+            sfname = os.path.abspath("{0}.wav".format(name))
+            cmd.extend(("--midi", midi_name, "--wav", sfname))
+            process.run(cmd, cwd=path, timeout=timeout)
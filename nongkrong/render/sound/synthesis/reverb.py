@@ -0,0 +1,100 @@
+import numpy as np
+
+"""Block based Schroeder reverb (parallel comb filters and serial allpass filters).
+
+Every filter only needs samples that are at least 'delay' samples old. Therefore
+every block that isn't longer than the delay of a filter can be processed with
+one vectorized numpy operation.
+"""
+
+
+class CombFilter(object):
+    """Feedback comb filter with a simple lowpass in its feedback path.
+
+    y[n] = x[n] + feedback * ((1 - damping) * y[n - delay] + damping * y[n - delay - 1])
+    """
+
+    def __init__(self, delay: int, feedback: float, damping: float = 0) -> None:
+        self.__delay = delay
+        self.__feedback = feedback
+        self.__damping = damping
+        # the last delay + 1 output samples
+        self.__history = np.zeros(delay + 1)
+
+    def __call__(self, signal: np.ndarray) -> np.ndarray:
+        result = np.empty(len(signal))
+        for position in range(0, len(signal), self.__delay):
+            block = signal[position : position + self.__delay]
+            size = len(block)
+            delayed = (1 - self.__damping) * self.__history[1 : size + 1]
+            delayed += self.__damping * self.__history[:size]
+            output = block + self.__feedback * delayed
+            result[position : position + size] = output
+            self.__history = np.concatenate((self.__history[size:], output))
+        return result
+
+
+class AllpassFilter(object):
+    """Schroeder allpass filter.
+
+    y[n] = -gain * x[n] + x[n - delay] + gain * y[n - delay]
+    """
+
+    def __init__(self, delay: int, gain: float = 0.5) -> None:
+        self.__delay = delay
+        self.__gain = gain
+        # the last delay input and output samples
+        self.__input_history = np.zeros(delay)
+        self.__output_history = np.zeros(delay)
+
+    def __call__(self, signal: np.ndarray) -> np.ndarray:
+        result = np.empty(len(signal))
+        for position in range(0, len(signal), self.__delay):
+            block = signal[position : position + self.__delay]
+            size = len(block)
+            output = -self.__gain * block + self.__input_history[:size]
+            output += self.__gain * self.__output_history[:size]
+            result[position : position + size] = output
+            self.__input_history = np.concatenate((self.__input_history[size:], block))
+            self.__output_history = np.concatenate(
+                (self.__output_history[size:], output)
+            )
+        return result
+
+
+class Reverb(object):
+    """Mono reverb similar to freeverb.
+
+    The delays of the filters are the delays of freeverb (that are defined for a
+    sample rate of 44100 Hz) scaled to the actual sample rate.
+    """
+
+    comb_delays = (1116, 1188, 1277, 1356)
+    allpass_delays = (556, 441)
+
+    def __init__(
+        self,
+        rate: int,
+        room_size: float = 0.7,
+        damping: float = 0.5,
+        gain: float = 0.1,
+    ) -> None:
+        factor = rate / 44100
+        feedback = (room_size * 0.28) + 0.7
+        self.__combs = tuple(
+            CombFilter(int(delay * factor), feedback, damping * 0.4)
+            for delay in Reverb.comb_delays
+        )
+        self.__allpasses = tuple(
+            AllpassFilter(int(delay * factor)) for delay in Reverb.allpass_delays
+        )
+        self.__gain = gain / len(self.__combs)
+
+    def __call__(self, signal: np.ndarray) -> np.ndarray:
+        signal = np.asarray(signal, dtype=float)
+        result = np.zeros(len(signal))
+        for comb in self.__combs:
+            result += comb(signal)
+        for allpass in self.__allpasses:
+            result = allpass(result)
+        return result * self.__gain
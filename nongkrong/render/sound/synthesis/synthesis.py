@@ -1,23 +1,105 @@
 import abc
+import copy
+import functools
+import itertools
 import os
-import sox
+
+import numpy as np
 
 from mu.mel import ji
 from mu.mel import mel
 from mu.sco import old
 
+from nongkrong.render.sound import process
+from nongkrong.render.sound.profile import FINAL
+from nongkrong.render.sound.profile import RenderProfile
+from nongkrong.render.sound import wav
 from nongkrong.render.sound.synthesis import pyteq
+from nongkrong.render.sound.synthesis import reverb
+
+
+def overlap_add(signals, frames: int, block_size: int):
+    """Yield blocks of the sum of all signals.
+
+    signals has to be an iterable of (start_frame, signal) pairs sorted by
+    start_frame. A signal is only taken from the iterable when the block in which
+    it starts is reached, so signals can be generated lazily.
+    """
+    signals = iter(signals)
+    next_signal = next(signals, None)
+    active_signals = []
+    for block_start in range(0, frames, block_size):
+        block_end = min((block_start + block_size, frames))
+        while next_signal is not None and next_signal[0] < block_end:
+            active_signals.append(next_signal)
+            next_signal = next(signals, None)
+        block = np.zeros(block_end - block_start)
+        for start, signal in active_signals:
+            position = max((block_start, start))
+            end = min((block_end, start + len(signal)))
+            if position < end:
+                block[position - block_start : end - block_start] += signal[
+                    position - start : end - start
+                ]
+        active_signals = [
+            item for item in active_signals if item[0] + len(item[1]) > block_end
+        ]
+        yield block
+
+
+def mk_file_info(path: str) -> tuple:
+    """Return size and modification time of a file (empty if it doesn't exist).
+
+    Used by engine configs, so that edited input files lead to new cache keys.
+    """
+    if path is None:
+        return tuple([])
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return tuple([])
+    return (stat.st_size, stat.st_mtime_ns)
 
 
 class SoundEngine(abc.ABC):
     CONCERT_PITCH = 260
+    # has to be increased whenever a change of the code changes the rendered
+    # soundfiles (so that old cached stems aren't used anymore)
+    VERSION = 1
+    # maximum time in seconds for one render (None for no limit)
+    timeout = None
+    profile = FINAL
 
     @abc.abstractmethod
     def __call__(self, name: str, cadence: old.JICadence) -> None:
         raise NotImplementedError
 
+    @property
+    def config(self) -> tuple:
+        """All settings that influence the rendered soundfile (for caching)."""
+        return (
+            type(self).__name__,
+            self.VERSION,
+            self.CONCERT_PITCH,
+        ) + self.profile.config
+
+    def with_profile(self, profile: RenderProfile) -> "SoundEngine":
+        """Return copy of the engine that renders with profile."""
+        engine = copy.copy(self)
+        engine.profile = profile
+        return engine
+
 
 class PyteqEngine(SoundEngine):
+    """Render cadences with Pianoteq.
+
+    For every time of tuning_dump_positions (for instance the start of every
+    section of a joined cadence) all midi keys get retuned with one bulk
+    message (see pyteq.MidiFile).
+    """
+
+    tuning_dump_positions = tuple([])
+
     def __init__(
         self, preset=None, fxp=None, available_midi_notes=tuple(range(128)), volume=0.7
     ):
@@ -42,6 +124,23 @@ class PyteqEngine(SoundEngine):
     def available_midi_notes(self) -> tuple:
         return self.__available_midi_notes
 
+    @property
+    def config(self) -> tuple:
+        return super(PyteqEngine, self).config + (
+            self.preset,
+            self.fxp,
+            mk_file_info(self.fxp),
+            tuple(self.available_midi_notes),
+            self.volume,
+            tuple(self.tuning_dump_positions),
+        )
+
+    def with_tuning_dump_positions(self, positions: tuple) -> "PyteqEngine":
+        """Return copy of the engine that retunes all keys at every position."""
+        engine = copy.copy(self)
+        engine.tuning_dump_positions = tuple(positions)
+        return engine
+
     def __call__(self, name: str, cadence: old.JICadence) -> None:
         seq = []
         for chord in cadence:
@@ -63,8 +162,21 @@ class PyteqEngine(SoundEngine):
             else:
                 seq.append(old.Rest(dur))
 
-        pt = pyteq.Pianoteq(tuple(seq), self.available_midi_notes)
-        pt.export2wav(name, 1, self.preset, self.fxp)
+        pt = pyteq.Pianoteq(
+            tuple(seq),
+            self.available_midi_notes,
+            tuning_dump_positions=self.tuning_dump_positions,
+            grid_resolution=self.profile.grid_resolution,
+        )
+        pt.export2wav(
+            name,
+            1,
+            self.preset,
+            self.fxp,
+            self.timeout,
+            self.profile.rate,
+            self.profile.pianoteq_bit_depth,
+        )
 
 
 class CsoundEngine(SoundEngine):
@@ -76,41 +188,55 @@ class CsoundEngine(SoundEngine):
     def mk_sco(self, cadence) -> str:
         raise NotImplementedError
 
+    @property
+    def config(self) -> tuple:
+        return super(CsoundEngine, self).config + (self.orc,)
+
     def __call__(self, name: str, cadence: old.JICadence) -> None:
         sfname = "{0}.wav".format(name)
-        fname = "csoundsynth"
-        orc_name = "{0}.orc".format(fname)
-        sco_name = "{0}.sco".format(fname)
         sco = self.mk_sco(cadence)
         if sco:
-            with open(orc_name, "w") as f:
-                f.write(self.orc)
-            with open(sco_name, "w") as f:
-                f.write(sco)
-            cmd0 = "csound --format=double -k 96000 -r 96000 -o {0} ".format(sfname)
-            cmd1 = "{0} {1}".format(orc_name, sco_name)
-            cmd = cmd0 + cmd1
-            os.system(cmd)
-            os.remove(orc_name)
-            os.remove(sco_name)
+            with process.workspace() as path:
+                orc_name = os.path.join(path, "csoundsynth.orc")
+                sco_name = os.path.join(path, "csoundsynth.sco")
+                with open(orc_name, "w") as f:
+                    f.write(self.orc)
+                with open(sco_name, "w") as f:
+                    f.write(sco)
+                cmd = ("csound",) + self.profile.csound_flags
+                cmd += ("-o", sfname, orc_name, sco_name)
+                process.run(cmd, timeout=self.timeout)
 
 
 class SampleEngine(CsoundEngine):
     """pitch2sample has to be a dict with the following structure:
 
-        {pitch0: CYCLE((SAMPLE_NAME, PITCH_FACTOR), (SAMPLE_NAME, PITCH_FACTOR), ...),
-         pitch1: CYCLE((SAMPLE_NAME, PITCH_FACTOR), ...),
+        {pitch0: ((SAMPLE_NAME, PITCH_FACTOR), (SAMPLE_NAME, PITCH_FACTOR), ...),
+         pitch1: ((SAMPLE_NAME, PITCH_FACTOR), ...),
          ...
-         pitchN: CYCLE((SAMPLE_NAME, PITCH_FACTOR), ...)}
+         pitchN: ((SAMPLE_NAME, PITCH_FACTOR), ...)}
+
+    Every render cycles through the samples of a pitch, starting with the
+    first sample.
+
+    With backend 'csound' the samples are played by csound, with backend
+    'numpy' they are played by the SamplePlaybackEngine.
     """
 
-    def __init__(self, pitch2sample: dict) -> None:
+    def __init__(self, pitch2sample: dict, backend: str = "csound") -> None:
+        if backend not in ("csound", "numpy"):
+            raise ValueError("Unknown backend '{0}'.".format(backend))
         self.__pitch2sample = pitch2sample
+        self.__backend = backend
 
     @property
     def pitch2sample(self) -> dict:
         return self.__pitch2sample
 
+    @property
+    def backend(self) -> str:
+        return self.__backend
+
     @property
     def orc(self) -> str:
         lines = (
@@ -131,24 +257,225 @@ class SampleEngine(CsoundEngine):
         )
         return "\n".join(lines)
 
-    def mk_sco(self, cadence) -> str:
-        lines = []
+    @property
+    def sample_config(self) -> tuple:
+        """All samples with size and modification time of their soundfiles."""
+        return tuple(
+            sorted(
+                (
+                    repr(pitch),
+                    tuple(tuple(s) + mk_file_info(s[0]) for s in s_infos),
+                )
+                for pitch, s_infos in self.pitch2sample.items()
+            )
+        )
+
+    @property
+    def config(self) -> tuple:
+        return super(SampleEngine, self).config + (self.sample_config, self.backend)
+
+    def mk_hits(self, cadence) -> tuple:
+        """Return (start, sample_name, factor, volume) for every played sample."""
+        samples_per_pitch = {
+            pitch: itertools.cycle(s_infos)
+            for pitch, s_infos in self.pitch2sample.items()
+        }
+        hits = []
         abs_start = cadence.delay.convert2absolute()
         for event, start in zip(cadence, abs_start):
             if event.pitch and event.pitch != mel.TheEmptyPitch:
-                line = r"i1 {0}".format(start)
                 for pi in event.pitch:
-                    s_info = next(self.pitch2sample[pi])
+                    s_info = next(samples_per_pitch[pi])
                     sample_name, factor = s_info[0], s_info[1]
                     if len(s_info) == 3:
                         vol = s_info[2]
                     else:
                         vol = 1
-                    duration = sox.file_info.duration(sample_name)
-                    final_line = '{0} {1} "{2}" {3} {4}'.format(
-                        line, duration, sample_name, factor, vol
-                    )
-                    lines.append(final_line)
+                    hits.append((start, sample_name, factor, vol))
+        return tuple(hits)
+
+    def mk_sco(self, cadence) -> str:
+        lines = []
+        for start, sample_name, factor, vol in self.mk_hits(cadence):
+            duration = wav.SAMPLE_INDEX.duration(sample_name)
+            final_line = 'i1 {0} {1} "{2}" {3} {4}'.format(
+                start, duration, sample_name, factor, vol
+            )
+            lines.append(final_line)
         complete_duration = float(cadence.duration + 5)
         lines.append("i2 0 {0}".format(complete_duration))
         return "\n".join(lines)
+
+    def __call__(self, name: str, cadence: old.JICadence) -> None:
+        if self.backend == "numpy":
+            engine = SamplePlaybackEngine(self.pitch2sample)
+            engine.with_profile(self.profile)(name, cadence)
+        else:
+            CsoundEngine.__call__(self, name, cadence)
+
+
+class SamplePlaybackEngine(SampleEngine):
+    """Play samples without csound (same pitch2sample as SampleEngine).
+
+    Samples are loaded only once per process. Every played sample is resampled
+    by its pitch factor with linear interpolation and added to the output, which
+    is rendered and written block by block. The freeverb send of the csound
+    orchestra is replaced by a similar Schroeder reverb (see reverb.Reverb).
+    """
+
+    block_size = 2**16
+    # every played sample is sent with this factor to the reverb
+    reverb_send = 0.1
+
+    def __init__(self, pitch2sample: dict) -> None:
+        super(SamplePlaybackEngine, self).__init__(pitch2sample)
+
+    @property
+    def rate(self) -> int:
+        return self.profile.rate
+
+    @property
+    def config(self) -> tuple:
+        # the csound orchestra and backend of SampleEngine aren't used
+        return SoundEngine.config.fget(self) + (self.sample_config, self.reverb_send)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def resample(sample_name: str, mtime: int, factor: float, rate: int) -> np.ndarray:
+        """Return mono sample played with factor at rate.
+
+        Like csounds diskin2 the resulting signal is as long as the sample itself.
+        mtime is only part of the cache key, so that edited samples are read again.
+        """
+        reader = wav.WavReader(sample_name)
+        signal = reader.read().sum(axis=1)
+        if factor == 1 and reader.rate == rate:
+            return signal
+        positions = np.arange(int(round(reader.duration * rate)))
+        positions = positions * (factor * reader.rate / rate)
+        return np.interp(positions, np.arange(len(signal)), signal, right=0)
+
+    def __call__(self, name: str, cadence: old.JICadence) -> None:
+        rate = self.rate
+        hits = []
+        for start, sample_name, factor, vol in self.mk_hits(cadence):
+            mtime = os.stat(sample_name).st_mtime_ns
+            signal = SamplePlaybackEngine.resample(sample_name, mtime, factor, rate)
+            hits.append((int(round(float(start) * rate)), signal, vol))
+        hits.sort(key=lambda hit: hit[0])
+        frames = int(round(float(cadence.duration + 5) * rate))
+        reverberation = reverb.Reverb(rate)
+        dry = overlap_add(
+            ((start, signal * vol) for start, signal, vol in hits),
+            frames,
+            self.block_size,
+        )
+        send = overlap_add(
+            ((start, signal) for start, signal, vol in hits), frames, self.block_size
+        )
+        sfname = "{0}.wav".format(name)
+        with wav.WavWriter(sfname, rate, 1, self.profile.sample_format) as writer:
+            for dry_block, send_block in zip(dry, send):
+                writer.write(dry_block + reverberation(send_block * self.reverb_send))
+
+
+class PreviewEngine(SoundEngine):
+    """Fast and simple replacement for PyteqEngine (for previews).
+
+    Every tone is synthesized by a sum of exponentially decaying sinusoids
+    (modal synthesis). Its frequency is exactly the JI pitch multiplied with
+    CONCERT_PITCH. Two models are available:
+
+        'string' -> harmonic partials of a plucked string
+        'bar' -> inharmonic partials of a struck free bar
+
+    After the duration of a tone it gets damped (like a released key).
+    """
+
+    block_size = 2**16
+    # (frequency_factor, amplitude) of the partials of a free bar
+    bar_modes = ((1, 1), (2.756, 0.5), (5.404, 0.25), (8.933, 0.12))
+    release_time = 0.08
+    max_partials = 16
+
+    def __init__(self, model: str = "string", volume: float = 0.7) -> None:
+        if model not in ("string", "bar"):
+            raise ValueError("Unknown model '{0}'.".format(model))
+        self.__model = model
+        self.__volume = volume
+
+    @property
+    def model(self) -> str:
+        return self.__model
+
+    @property
+    def volume(self) -> float:
+        return self.__volume
+
+    @property
+    def rate(self) -> int:
+        return self.profile.rate
+
+    @property
+    def config(self) -> tuple:
+        return super(PreviewEngine, self).config + (self.model, self.volume)
+
+    def mk_modes(self, frequency: float) -> tuple:
+        """Return frequencies, amplitudes and decay times of all partials."""
+        nyquist = self.rate / 2
+        if self.model == "string":
+            numbers = np.arange(1, self.max_partials + 1)
+            frequencies = frequency * numbers
+            # plucked at 1/7 of the string length
+            amplitudes = np.abs(np.sin(numbers * np.pi / 7)) / numbers
+            decay_times = 3 * (110 / max(frequency, 110)) ** 0.5 / numbers**0.7
+        else:
+            modes = np.array(self.bar_modes)
+            frequencies = frequency * modes[:, 0]
+            amplitudes = modes[:, 1]
+            decay_times = 1.5 * (220 / max(frequency, 220)) ** 0.5 / modes[:, 0]
+        is_audible = frequencies < nyquist
+        return (
+            frequencies[is_audible],
+            amplitudes[is_audible],
+            decay_times[is_audible],
+        )
+
+    def synthesize(self, frequency: float, duration: float) -> np.ndarray:
+        frequencies, amplitudes, decay_times = self.mk_modes(frequency)
+        if not len(frequencies):
+            # all partials are above the nyquist frequency
+            return np.zeros(0)
+        length = min((duration + self.release_time * 8, decay_times.max() * 7))
+        time = np.arange(int(length * self.rate)) / self.rate
+        signal = np.zeros(len(time))
+        for freq, amplitude, decay_time in zip(frequencies, amplitudes, decay_times):
+            envelope = amplitude * np.exp(-time / decay_time)
+            signal += envelope * np.sin(2 * np.pi * freq * time)
+        released = time > duration
+        signal[released] *= np.exp(-(time[released] - duration) / self.release_time)
+        return signal * (self.volume / amplitudes.sum())
+
+    def mk_tones(self, cadence) -> tuple:
+        """Return (start, frequency, duration) for every tone."""
+        tones = []
+        abs_start = cadence.delay.convert2absolute()
+        for chord, start in zip(cadence, abs_start):
+            if chord.pitch != mel.TheEmptyPitch and bool(chord.pitch):
+                for pi in chord.pitch:
+                    frequency = ji.JIPitch(pi, multiply=self.CONCERT_PITCH).freq
+                    tones.append((float(start), frequency, float(chord.delay)))
+        return tuple(tones)
+
+    def __call__(self, name: str, cadence: old.JICadence) -> None:
+        rate = self.rate
+        tones = sorted(self.mk_tones(cadence))
+        frames = int(round(float(cadence.duration + 5) * rate))
+        signals = (
+            (int(round(start * rate)), self.synthesize(frequency, duration))
+            for start, frequency, duration in tones
+        )
+        sfname = "{0}.wav".format(name)
+        with wav.WavWriter(sfname, rate, 1, self.profile.sample_format) as writer:
+            for block in overlap_add(signals, frames, self.block_size):
+                writer.write(block)
@@ -0,0 +1,245 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+"""This module implements reading and writing of WAV files with NumPy.
+
+Soundfiles are read via memory mapping and written block by block, so that
+arbitrary long soundfiles can be processed with a constant amount of memory.
+Samples are always returned as float64 arrays with the shape (frames, channels).
+"""
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# sample_format -> (format_tag, bits per sample)
+SAMPLE_FORMATS = {
+    "int16": (WAVE_FORMAT_PCM, 16),
+    "int24": (WAVE_FORMAT_PCM, 24),
+    "int32": (WAVE_FORMAT_PCM, 32),
+    "float": (WAVE_FORMAT_IEEE_FLOAT, 32),
+    "double": (WAVE_FORMAT_IEEE_FLOAT, 64),
+}
+
+
+def read_header(path: str) -> tuple:
+    """Return (format_tag, channels, rate, bits, data_offset, frames) of WAV file."""
+    with open(path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError("'{0}' isn't a WAV file.".format(path))
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError("'{0}' doesn't contain any data.".format(path))
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                data = f.read(chunk_size)
+                fmt = struct.unpack("<HHIIHH", data[:16])
+                format_tag = fmt[0]
+                if format_tag == WAVE_FORMAT_EXTENSIBLE:
+                    format_tag = struct.unpack("<H", data[24:26])[0]
+                fmt = (format_tag,) + fmt[1:]
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise ValueError("'{0}' has no format chunk.".format(path))
+                format_tag, channels, rate, _, block_align, bits = fmt
+                offset = f.tell()
+                # unfinished files can contain less data than announced
+                data_size = min((chunk_size, os.path.getsize(path) - offset))
+                return (
+                    format_tag,
+                    channels,
+                    rate,
+                    bits,
+                    offset,
+                    data_size // block_align,
+                )
+            else:
+                # chunks are aligned to two bytes
+                f.seek(chunk_size + (chunk_size % 2), 1)
+
+
+class WavReader(object):
+    """Read samples of a WAV file via memory mapping."""
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        header = read_header(path)
+        format_tag, self.__channels, self.__rate, bits, offset, self.__frames = header
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            dtype, self.__factor = {32: "<f4", 64: "<f8"}[bits], 1
+        elif format_tag == WAVE_FORMAT_PCM:
+            dtype = {8: "u1", 16: "<i2", 24: "u1", 32: "<i4"}[bits]
+            self.__factor = 1 / (2 ** (bits - 1))
+        else:
+            raise ValueError("Unsupported WAV format {0}.".format(format_tag))
+        self.__bits = bits
+        if self.__frames:
+            shape = (self.__frames, self.__channels * (1 + 2 * (bits == 24)))
+            self.__data = np.memmap(
+                path, dtype=dtype, mode="r", offset=offset, shape=shape
+            )
+        else:
+            self.__data = np.zeros((0, self.__channels))
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def channels(self) -> int:
+        return self.__channels
+
+    @property
+    def rate(self) -> int:
+        return self.__rate
+
+    @property
+    def frames(self) -> int:
+        return self.__frames
+
+    @property
+    def duration(self) -> float:
+        return self.__frames / self.__rate
+
+    def read(self, start: int = 0, amount: int = None) -> np.ndarray:
+        """Return samples from frame start to frame start + amount."""
+        if amount is None:
+            amount = self.__frames - start
+        data = np.asarray(self.__data[start : start + amount])
+        if self.__bits == 8:
+            data = data.astype(float) - 128
+        elif self.__bits == 24:
+            data = data.reshape(len(data), self.__channels, 3).astype(np.int32)
+            data = data[:, :, 0] | (data[:, :, 1] << 8) | (data[:, :, 2] << 16)
+            data = np.where(data >= 2**23, data - 2**24, data)
+        return data.astype(float) * self.__factor
+
+
+class WavWriter(object):
+    """Write a WAV file block by block.
+
+    The sizes in the header are written when the writer gets closed.
+    """
+
+    def __init__(
+        self, path: str, rate: int, channels: int, sample_format: str = "double"
+    ) -> None:
+        self.__format_tag, self.__bits = SAMPLE_FORMATS[sample_format]
+        self.__sample_format = sample_format
+        self.__channels = channels
+        self.__rate = rate
+        self.__frames = 0
+        self.__file = open(path, "wb")
+        self.write_header()
+
+    def write_header(self) -> None:
+        block_align = self.__channels * self.__bits // 8
+        data_size = self.__frames * block_align
+        is_float = self.__format_tag == WAVE_FORMAT_IEEE_FLOAT
+        # float WAV files have to contain an extended format chunk and a fact chunk
+        fmt_size = 16 + 2 * is_float
+        riff_size = 4 + 8 + fmt_size + 8 + data_size + (data_size % 2)
+        riff_size += 12 * is_float
+        self.__file.seek(0)
+        self.__file.write(struct.pack("<4sI4s", b"RIFF", riff_size, b"WAVE"))
+        self.__file.write(
+            struct.pack(
+                "<4sIHHIIHH",
+                b"fmt ",
+                fmt_size,
+                self.__format_tag,
+                self.__channels,
+                self.__rate,
+                self.__rate * block_align,
+                block_align,
+                self.__bits,
+            )
+        )
+        if is_float:
+            self.__file.write(struct.pack("<H", 0))
+            self.__file.write(struct.pack("<4sII", b"fact", 4, self.__frames))
+        self.__file.write(struct.pack("<4sI", b"data", data_size))
+
+    def write(self, block: np.ndarray) -> None:
+        """Append block with the shape (frames, channels) of float samples."""
+        block = np.asarray(block, dtype=float).reshape(-1, self.__channels)
+        if self.__sample_format == "double":
+            data = block.astype("<f8")
+        elif self.__sample_format == "float":
+            data = block.astype("<f4")
+        else:
+            maximum = 2 ** (self.__bits - 1)
+            data = np.clip(np.round(block * maximum), -maximum, maximum - 1)
+            data = data.astype("<i4")
+            if self.__bits == 16:
+                data = data.astype("<i2")
+            elif self.__bits == 24:
+                data = data.view("u1").reshape(len(data), self.__channels, 4)
+                data = data[:, :, :3]
+        self.__file.write(np.ascontiguousarray(data).tobytes())
+        self.__frames += len(block)
+
+    def close(self) -> None:
+        if not self.__file.closed:
+            if (self.__frames * self.__channels * self.__bits // 8) % 2:
+                # chunks are aligned to two bytes
+                self.__file.write(b"\x00")
+            self.write_header()
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class SampleIndex(object):
+    """Index of the metadata (duration, channels, rate, frames) of WAV files.
+
+    The header of every file is only read once. If a file has been modified
+    since it has been read, its metadata will be read again. If path is not
+    None, the index is loaded from and saved to a JSON file.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.__path = path
+        self.__info_per_file = {}
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.__info_per_file = {key: tuple(value) for key, value in data.items()}
+
+    def __len__(self) -> int:
+        return len(self.__info_per_file)
+
+    def info(self, name: str) -> tuple:
+        """Return (duration, channels, rate, frames) of WAV file."""
+        stat = os.stat(name)
+        key = os.path.abspath(name)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        data = self.__info_per_file.get(key)
+        if data is None or tuple(data[:2]) != signature:
+            _, channels, rate, _, _, frames = read_header(name)
+            data = signature + (frames / rate, channels, rate, frames)
+            self.__info_per_file[key] = data
+        return data[2:]
+
+    def duration(self, name: str) -> float:
+        return self.info(name)[0]
+
+    def save(self, path: str = None) -> None:
+        if path is None:
+            path = self.__path
+        with open(path, "w") as f:
+            json.dump(self.__info_per_file, f)
+
+
+# process wide index
+SAMPLE_INDEX = SampleIndex()
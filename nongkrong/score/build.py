@@ -0,0 +1,237 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+"""This module implements a small build system for the outputs of a Score.
+
+A build is described by a graph of Node objects. Every node has a key, which is
+a content hash of its own data and of the keys of all its dependencies. The keys
+of all successfully built nodes are saved in a JSON file. A node is stale if its
+key differs from the saved key or if one of its output files is missing. Only
+stale nodes are executed; nodes that don't depend on each other run at the same
+time.
+"""
+
+
+class Node(object):
+    """One step of a build.
+
+    data describes the content of the node. It can be a string or a function
+    that returns a string (for data that is expensive to compute, since it is
+    only called if the key of the node is needed). Nodes without action only
+    exist to pass their key to the nodes that depend on them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        data,
+        dependencies: tuple = tuple([]),
+        action=None,
+        outputs: tuple = tuple([]),
+    ) -> None:
+        self.__name = name
+        self.__data = data
+        self.__dependencies = tuple(dependencies)
+        self.__action = action
+        self.__outputs = tuple(outputs)
+        self.__key = None
+
+    def __repr__(self) -> str:
+        return "Node({0})".format(self.name)
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def dependencies(self) -> tuple:
+        return self.__dependencies
+
+    @property
+    def action(self):
+        return self.__action
+
+    @property
+    def outputs(self) -> tuple:
+        return self.__outputs
+
+    @property
+    def key(self) -> str:
+        if self.__key is None:
+            data = self.__data
+            if callable(data):
+                data = data()
+            key = hashlib.sha256()
+            key.update(self.name.encode())
+            key.update(str(data).encode())
+            for dependency in self.dependencies:
+                key.update(dependency.key.encode())
+            self.__key = key.hexdigest()
+        return self.__key
+
+
+class BuildState(object):
+    """Keys of all successfully built nodes, saved in a JSON file."""
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__key_per_node = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.__key_per_node = json.load(f)
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    def get(self, name: str) -> str:
+        return self.__key_per_node.get(name)
+
+    def set(self, name: str, key: str) -> None:
+        with self.__lock:
+            self.__key_per_node[name] = key
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            tmp_path = "{0}.tmp".format(self.path)
+            with open(tmp_path, "w") as f:
+                json.dump(self.__key_per_node, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class Graph(object):
+    """Build graph with the nodes and all their dependencies.
+
+    Targets are names of nodes. A target also selects all nodes whose name
+    starts with the target and a slash ('sound' selects 'sound/mix', ...).
+    """
+
+    def __init__(self, nodes: tuple, state_path: str = "output/build.json") -> None:
+        self.__node_per_name = {}
+        for node in Graph.sort(nodes):
+            if self.__node_per_name.get(node.name, node) is not node:
+                raise ValueError("Node name '{0}' isn't unique.".format(node.name))
+            self.__node_per_name[node.name] = node
+        self.__state = BuildState(state_path)
+
+    @staticmethod
+    def sort(nodes: tuple) -> tuple:
+        """Return nodes and all their dependencies in topological order."""
+        result = []
+        visited = set([])
+        for node in nodes:
+            stack = [(node, False)]
+            while stack:
+                item, is_expanded = stack.pop()
+                if is_expanded:
+                    result.append(item)
+                elif id(item) not in visited:
+                    visited.add(id(item))
+                    stack.append((item, True))
+                    for dependency in reversed(item.dependencies):
+                        stack.append((dependency, False))
+        return tuple(result)
+
+    @property
+    def nodes(self) -> tuple:
+        return tuple(self.__node_per_name.values())
+
+    @property
+    def state(self) -> BuildState:
+        return self.__state
+
+    def __getitem__(self, name: str) -> Node:
+        return self.__node_per_name[name]
+
+    def select(self, targets: tuple = None) -> tuple:
+        """Return all nodes that are needed for targets in topological order."""
+        if targets is None:
+            return Graph.sort(self.nodes)
+        selected = []
+        for target in targets:
+            matches = tuple(
+                node
+                for name, node in self.__node_per_name.items()
+                if name == target or name.startswith("{0}/".format(target))
+            )
+            if not matches:
+                raise KeyError("Unknown target '{0}'.".format(target))
+            selected.extend(matches)
+        return Graph.sort(selected)
+
+    def is_stale(self, node: Node) -> bool:
+        if node.action is None:
+            return False
+        if self.state.get(node.name) != node.key:
+            return True
+        return not all(os.path.exists(path) for path in node.outputs)
+
+    def stale(self, targets: tuple = None) -> tuple:
+        """Return all stale nodes that are needed for targets in topological order."""
+        return tuple(node for node in self.select(targets) if self.is_stale(node))
+
+    def build(
+        self, targets: tuple = None, jobs: int = None, dry_run: bool = False
+    ) -> tuple:
+        """Run all stale nodes that are needed for targets and return them.
+
+        At most jobs nodes (by default as many as the machine has CPUs) are
+        running at the same time in a thread pool. A node starts as soon as
+        all stale nodes it depends on are finished. If dry_run is True, the
+        stale nodes are only returned. If any node raises an exception, all
+        waiting nodes are cancelled and the exception is raised again.
+        """
+        stale_nodes = self.stale(targets)
+        if dry_run or not stale_nodes:
+            return stale_nodes
+
+        stale_names = set(node.name for node in stale_nodes)
+        # names of stale nodes every stale node is waiting for
+        waiting_for = {}
+        for node in stale_nodes:
+            waiting_for[node.name] = set(
+                dependency.name
+                for dependency in Graph.sort(node.dependencies)
+                if dependency.name in stale_names
+            )
+
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            running_nodes = {}
+
+            def submit_ready_nodes() -> None:
+                for name, waiting in tuple(waiting_for.items()):
+                    if not waiting:
+                        del waiting_for[name]
+                        node = self[name]
+                        running_nodes[executor.submit(node.action)] = node
+
+            submit_ready_nodes()
+            amount_finished_nodes = 0
+            while running_nodes:
+                finished, _ = concurrent.futures.wait(
+                    running_nodes, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    node = running_nodes.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        for waiting_future in running_nodes:
+                            waiting_future.cancel()
+                        raise exception
+                    self.state.set(node.name, node.key)
+                    amount_finished_nodes += 1
+                    print(
+                        "[{0}/{1}] built {2}".format(
+                            amount_finished_nodes, len(stale_nodes), node.name
+                        )
+                    )
+                    for waiting in waiting_for.values():
+                        waiting.discard(node.name)
+                submit_ready_nodes()
+        return stale_nodes
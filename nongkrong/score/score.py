@@ -1,9 +1,14 @@
+import bisect
+import collections
+import concurrent.futures
 import functools
 import operator
 import os
 import itertools
 import sys
 
+import numpy as np
+
 from mu.mel import mel
 from mu.mel import ji
 from mu.sco import old
@@ -14,7 +19,7 @@ from nongkrong.metre import metre
 from nongkrong.tempo import tempo
 from nongkrong.render import notation
 from nongkrong.render import sound
-
+from nongkrong.score import build
 
 """This module implements classes to organise compositions in hierarchical structures.
 
@@ -65,12 +70,11 @@ class Score(object):
         section_data = tuple(Score.get_data_of_section(path) for path in section_path)
         info = Score.convert2valid_sections(section_data)
         self.__sections, self.__mdc_gong, self.__mdc_tong = info
-        self.__document_per_instrument = self.mk_document_for_each_instrument(
-            self.__sections
-        )
-        self.__ssd_per_instr = self.mk_soundsynthdata_for_each_instrument(
-            self.__sections
-        )
+        # notation sections and sound synthesis data are only made once they
+        # are needed for the first time (see mk_notation_section and
+        # mk_soundsynthdata). Both are saved per (section_idx, instrument_idx).
+        self.__notation_section_cache = {}
+        self.__ssd_cache = {}
 
     @staticmethod
     def get_data_of_section(section_path) -> tuple:
@@ -225,69 +229,148 @@ class Score(object):
     def mdc_tong_per_sec(self) -> tuple:
         return self.__mdc_tong
 
-    def mk_document_for_each_instrument(self, sections) -> tuple:
-        sec_per_instrument = [[] for i in Score.INSTRUMENTS]
-        for idx_sec, section in enumerate(sections):
-            name = section[0]
+    @staticmethod
+    def mk_indices(items, names: tuple, kind: str) -> tuple:
+        """Return indices of items (indices or names that are elements of names).
+
+        If items is None, the indices of all names are returned.
+        """
+        if items is None:
+            return tuple(range(len(names)))
+        indices = []
+        for item in items:
+            if isinstance(item, str):
+                if item not in names:
+                    raise KeyError("Unknown {0} '{1}'.".format(kind, item))
+                item = names.index(item)
+            elif not 0 <= item < len(names):
+                raise IndexError("There is no {0} with index {1}.".format(kind, item))
+            indices.append(item)
+        return tuple(indices)
+
+    @staticmethod
+    def mk_instrument_indices(instruments=None) -> tuple:
+        names = tuple(ins.name for ins in Score.SIMPLIFIED_INSTRUMENTS)
+        return Score.mk_indices(instruments, names, "instrument")
+
+    def mk_section_indices(self, sections=None) -> tuple:
+        names = tuple(section[0] for section in self.__sections)
+        return Score.mk_indices(sections, names, "section")
+
+    def mk_suffix(self, section_indices: tuple) -> str:
+        """Return suffix for names of outputs that only contain some sections."""
+        if tuple(section_indices) == tuple(range(len(self.__sections))):
+            return ""
+        return "_sections_{0}".format("_".join(str(idx) for idx in section_indices))
+
+    def mk_notation_section(self, section_idx: int, ins_idx: int) -> notation.Section:
+        key = (section_idx, ins_idx)
+        if key not in self.__notation_section_cache:
+            section = self.__sections[section_idx]
             tempo_per_unit = section[2][0]  # second element is for sound synthesis
-            delay_per_unit = section[3]
-            for ins_idx, ins_mdc, ins in zip(
-                range(len(Score.INSTRUMENTS)), section[1], section[4]
-            ):
-                print("NEW ISNTR")
-                print(ins.name)
-                print(ins_mdc)
-                print("")
-                not_sec = notation.Section(
-                    name,
-                    ins_mdc,
-                    ins,
-                    tempo_per_unit,
-                    self.TEMPO_LINE_STYLE,
-                    delay_per_unit,
-                    self.mdc_gong_per_sec[idx_sec],
-                    self.mdc_tong_per_sec[idx_sec],
-                )
-                sec_per_instrument[ins_idx].append(not_sec)
+            ins_mdc, ins = section[1][ins_idx], section[4][ins_idx]
+            self.__notation_section_cache[key] = notation.Section(
+                section[0],
+                ins_mdc,
+                ins,
+                tempo_per_unit,
+                self.TEMPO_LINE_STYLE,
+                section[3],
+                self.mdc_gong_per_sec[section_idx],
+                self.mdc_tong_per_sec[section_idx],
+            )
+        return self.__notation_section_cache[key]
+
+    def mk_document_name(self, ins_idx: int, section_indices: tuple) -> str:
+        return "{0}_{1}{2}".format(
+            self.name,
+            Score.SIMPLIFIED_INSTRUMENTS[ins_idx].name,
+            self.mk_suffix(section_indices),
+        )
+
+    def mk_document(self, ins_idx: int, section_indices: tuple) -> notation.Document:
+        return notation.Document(
+            self.mk_document_name(ins_idx, section_indices),
+            *(self.mk_notation_section(idx, ins_idx) for idx in section_indices),
+        )
+
+    def mk_document_for_each_instrument(
+        self, instruments: tuple = None, sections: tuple = None
+    ) -> tuple:
+        """Return one notation.Document for each instrument.
+
+        instruments and sections can be used to choose only some instruments
+        and sections (by index or by name). Every notation.Section is only
+        made once and reused for all following documents.
+        """
+        section_indices = self.mk_section_indices(sections)
         return tuple(
-            notation.Document("{0}_{1}".format(self.name, ins.name), *se)
-            for se, ins in zip(sec_per_instrument, Score.SIMPLIFIED_INSTRUMENTS)
+            self.mk_document(ins_idx, section_indices)
+            for ins_idx in Score.mk_instrument_indices(instruments)
         )
 
-    def mk_soundsynthdata_for_each_instrument(self, data_per_section) -> tuple:
-        sec_per_instrument = [[] for i in Score.INSTRUMENTS]
-        for idx_sec, section in enumerate(data_per_section):
+    def mk_soundsynthdata(self, section_idx: int, ins_idx: int) -> tuple:
+        """Return (cadences, sound_engines, name) of one instrument in one section."""
+        key = (section_idx, ins_idx)
+        if key not in self.__ssd_cache:
+            section = self.__sections[section_idx]
             tempo_per_unit = section[2][1]  # first element is for notation
-            delay_per_unit = section[3]
-            for ins_idx, ins_mdc, ins in zip(
-                range(len(Score.INSTRUMENTS)), section[1], section[4]
-            ):
-                divided_mdcs, sound_engines = ins_mdc.divide_by_sound_engine(ins)
-                cadences = tuple(
-                    dimdc.convert2cadence(tempo_per_unit, delay_per_unit)
-                    for dimdc in divided_mdcs
-                )
-                sec_per_instrument[ins_idx].append((cadences, sound_engines, ins.name))
-        cadences_and_soundengines_pairs_per_instrument = []
+            ins_mdc, ins = section[1][ins_idx], section[4][ins_idx]
+            divided_mdcs, sound_engines = ins_mdc.divide_by_sound_engine(ins)
+            cadences = tuple(
+                dimdc.convert2cadence(tempo_per_unit, section[3])
+                for dimdc in divided_mdcs
+            )
+            self.__ssd_cache[key] = (cadences, sound_engines, ins.name)
+        return self.__ssd_cache[key]
+
+    def mk_sectioned_soundsynthdata(
+        self, instruments: tuple = None, sections: tuple = None
+    ) -> tuple:
+        """Return (name, sound_engines, cadences_per_section) for each instrument.
+
+        cadences_per_section contains one tuple for every section with one
+        cadence for every sound engine. instruments and sections have the
+        same meaning as in mk_document_for_each_instrument.
+        """
+        section_indices = self.mk_section_indices(sections)
         ig0 = operator.itemgetter(0)
-        for inst in sec_per_instrument:
+        sectioned_data = []
+        for ins_idx in Score.mk_instrument_indices(instruments):
+            inst = tuple(
+                self.mk_soundsynthdata(sec_idx, ins_idx) for sec_idx in section_indices
+            )
             div_cadences = tuple(ig0(i) for i in inst)
             sound_engines = inst[0][1]
             ins_name = inst[0][2]
+            assert all(len(c) == len(sound_engines) for c in div_cadences)
+            sectioned_data.append((ins_name, sound_engines, div_cadences))
+        return tuple(sectioned_data)
+
+    @staticmethod
+    def join_sectioned_soundsynthdata(sectioned_data) -> tuple:
+        """Join the cadences of all sections (one cadence per sound engine)."""
+        cadences_and_soundengines_pairs_per_instrument = []
+        for ins_name, sound_engines, div_cadences in sectioned_data:
             zipped = zip(*div_cadences)
             cadences = tuple(functools.reduce(operator.add, c) for c in zipped)
-            assert len(cadences) == len(sound_engines)
             cadence_sound_engine_pair = tuple(zip(cadences, sound_engines))
             cadences_and_soundengines_pairs_per_instrument.append(
                 (ins_name, cadence_sound_engine_pair)
             )
         return tuple(cadences_and_soundengines_pairs_per_instrument)
 
-    def render_notation(self) -> None:
+    def render_notation(
+        self, instruments: tuple = None, sections: tuple = None
+    ) -> None:
+        """Render one document per instrument (see mk_document_for_each_instrument).
+
+        No sound synthesis data is made for rendering the notation.
+        """
         directory = "output/notation/"
         if not os.path.exists(directory):
             os.makedirs(directory)
-        for doc in self.__document_per_instrument:
+        for doc in self.mk_document_for_each_instrument(instruments, sections):
             doc.render(directory)
 
     @property
@@ -302,32 +385,577 @@ class Score(object):
             (0.98, 0.4, 0),
         )
 
-    def render_sound(self) -> None:
-        directory = "output/sound/"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    def mk_mix_data(self, instruments: tuple = None) -> tuple:
+        return tuple(
+            self.mix_data[ins_idx]
+            for ins_idx in Score.mk_instrument_indices(instruments)
+        )
+
+    @staticmethod
+    def mk_preview_engine(sound_engine):
+        if isinstance(sound_engine, sound.PyteqEngine):
+            return sound.PreviewEngine(volume=sound_engine.volume)
+        return sound_engine
+
+    def mk_stems(
+        self,
+        directory: str,
+        preview: bool,
+        profile: sound.RenderProfile,
+        sectioned: bool,
+        instruments: tuple = None,
+        sections: tuple = None,
+    ) -> tuple:
+        """Return stems per instrument and the name of the mix of every instrument.
+
+        One stem consist of (NAME, CADENCE, SOUND_ENGINE, START, SECTION_INDEX)
+        where SECTION_INDEX is None for stems that aren't sectioned. instruments
+        and sections have the same meaning as in mk_document_for_each_instrument.
+        """
+        section_indices = self.mk_section_indices(sections)
+        suffix_sections = self.mk_suffix(section_indices)
+        sectioned_ssd_per_instr = self.mk_sectioned_soundsynthdata(
+            instruments, section_indices
+        )
+        ssd_per_instr = Score.join_sectioned_soundsynthdata(sectioned_ssd_per_instr)
         files = []
-        for ssd in self.__ssd_per_instr:
-            instr_files = []
+        stems_per_instrument = []
+        for ssd, sectioned_ssd in zip(ssd_per_instr, sectioned_ssd_per_instr):
             name = ssd[0]
             directory_local = "{0}{1}/".format(directory, name)
+            if sectioned:
+                stem_data = Score.mk_section_stems(*sectioned_ssd[1:], section_indices)
+            else:
+                stem_data = []
+                for idx, (cadence, se) in enumerate(ssd[1]):
+                    if isinstance(se, sound.PyteqEngine):
+                        section_starts = Score.mk_section_starts(sectioned_ssd[2], idx)
+                        se = se.with_tuning_dump_positions(section_starts)
+                    suffix = "{0}{1}".format(idx, suffix_sections)
+                    stem_data.append((suffix, cadence, se, 0, None))
+            stems = []
+            for suffix, cadence, se, start, section_idx in stem_data:
+                if preview:
+                    se = Score.mk_preview_engine(se)
+                stem_name = "{0}{1}".format(directory_local, suffix)
+                se = se.with_profile(profile)
+                stems.append((stem_name, cadence, se, start, section_idx))
+            stems_per_instrument.append(tuple(stems))
+            files.append("{0}{1}{2}".format(directory_local, name, suffix_sections))
+        return tuple(stems_per_instrument), tuple(files)
+
+    @staticmethod
+    def render_stem(name: str, cadence, sound_engine, stem_cache=None) -> None:
+        directory = os.path.dirname(name)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        if stem_cache is not None:
+            stem_cache.render(name, cadence, sound_engine)
+        else:
+            sound_engine(name, cadence)
+
+    @staticmethod
+    def mix_stems(
+        name: str, inputdata: tuple, sectioned: bool, profile: sound.RenderProfile
+    ) -> None:
+        """Mix stems (inputdata contains (STEM_NAME, START) pairs) to one soundfile."""
+        if sectioned:
+            sound.mix_sections(name, *inputdata, profile=profile)
+        else:
+            sound.mix_mono(name, *(stem[0] for stem in inputdata), profile=profile)
+
+    @staticmethod
+    def render_document(document, directory: str) -> None:
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        document.render(directory)
+
+    @staticmethod
+    def mk_section_stems(
+        sound_engines: tuple, cadences_per_section: tuple, section_indices=None
+    ) -> tuple:
+        """Return (suffix, cadence, sound_engine, start, section_idx) per section stem.
+
+        start is the sum of the durations of the cadences of all previous
+        sections, so that the section stems are at the same positions as in
+        the joined cadence. The suffix contains the index of the section in
+        the score (section_indices, by default 0, 1, 2, ...).
+        """
+        if section_indices is None:
+            section_indices = range(len(cadences_per_section))
+        stems = []
+        for engine_idx, se in enumerate(sound_engines):
+            start = 0
+            for section_idx, cadences in zip(section_indices, cadences_per_section):
+                cadence = cadences[engine_idx]
+                suffix = "{0}_{1}".format(engine_idx, section_idx)
+                stems.append((suffix, cadence, se, start, section_idx))
+                start += float(cadence.duration)
+        return tuple(stems)
+
+    @staticmethod
+    def mk_section_starts(cadences_per_section: tuple, engine_idx: int) -> tuple:
+        """Return the start of every section but the first in the joined cadence."""
+        durations = (
+            float(cadences[engine_idx].duration) for cadences in cadences_per_section
+        )
+        return tuple(itertools.accumulate(durations))[:-1]
+
+    @staticmethod
+    def mk_executor(jobs: int) -> concurrent.futures.Executor:
+        """Return executor that runs at most jobs render tasks at the same time.
+
+        With only one job, all tasks are run one after another in one background
+        thread of the current process.
+        """
+        if jobs > 1:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def render_sound(
+        self,
+        jobs: int = 1,
+        cache: bool = True,
+        preview: bool = False,
+        profile: sound.RenderProfile = sound.FINAL,
+        sectioned: bool = False,
+        instruments: tuple = None,
+        sections: tuple = None,
+    ) -> None:
+        """Render one soundfile per instrument and mix them to the final soundfile.
+
+        Every (cadence, sound engine) pair of every instrument is rendered as a
+        separate task. At most jobs tasks are running at the same time (see
+        render_and_mix).
+
+        If cache is True, stems that have already been rendered with the same
+        cadence and the same sound engine settings are taken from
+        output/cache/ (see nongkrong.render.sound.cache.StemCache). Set cache
+        to False to render every stem again.
+
+        If preview is True, all stems that would be rendered by Pianoteq are
+        synthesized by the much faster PreviewEngine instead.
+
+        All stems and mixes are rendered with the sample rate and sample format
+        of profile (for instance sound.FINAL or the faster sound.DRAFT).
+
+        If sectioned is True, every section of every (cadence, sound engine)
+        pair is rendered as a separate stem. Those stems are mixed at the start
+        positions of their sections, so that the release of a section overlaps
+        with the following section. Since every section stem is cached on its
+        own, only edited sections have to be rendered again.
+
+        instruments and sections (indices or names) can be used to render only
+        some instruments or sections. Names of soundfiles that don't contain
+        all sections end with the indices of their sections. No notation is
+        made for rendering soundfiles.
+        """
+        directory = "output/sound/"
+        section_indices = self.mk_section_indices(sections)
+        stems_per_instrument, files = self.mk_stems(
+            directory, preview, profile, sectioned, instruments, section_indices
+        )
+        for file_name in files:
+            directory_local = os.path.dirname(file_name)
             if not os.path.exists(directory_local):
                 os.makedirs(directory_local)
-            for idx, pair in enumerate(ssd[1]):
-                file_name = "{0}{1}".format(directory_local, idx)
-                cadence, se = pair
-                se(file_name, cadence)
-                instr_files.append(file_name)
-            final_file = "{0}{1}".format(directory_local, name)
-            sound.mix_mono(final_file, *tuple("{0}".format(ifn) for ifn in instr_files))
-            files.append(final_file)
-        res = "{0}{1}".format(directory, self.name)
-        input_data = tuple((n,) + mixinfo for n, mixinfo in zip(files, self.mix_data))
-        sound.mix_complex(res, *input_data)
+
+        if cache:
+            stem_cache = sound.StemCache("output/cache/")
+        else:
+            stem_cache = None
+
+        res = "{0}{1}{2}".format(directory, self.name, self.mk_suffix(section_indices))
+        Score.render_and_mix(
+            stems_per_instrument,
+            files,
+            self.mk_mix_data(instruments),
+            res,
+            jobs,
+            stem_cache,
+            sectioned,
+            profile,
+        )
+
+    @staticmethod
+    def render_and_mix(
+        stems_per_instrument: tuple,
+        files: tuple,
+        mix_data: tuple,
+        name: str,
+        jobs: int = 1,
+        stem_cache=None,
+        sectioned: bool = False,
+        profile: sound.RenderProfile = sound.FINAL,
+    ) -> None:
+        """Render all stems, mix them per instrument and mix all instruments.
+
+        stems_per_instrument and files are made by mk_stems, mix_data contains
+        (VOLUME, PAN, START) for every instrument and name is the name of the
+        final stereo mix. Every stem is a separate task. At most jobs tasks
+        are running at the same time (see mk_executor). The mix of an
+        instrument starts as soon as all its own stems are finished. The final
+        mix starts after all instruments have been mixed. If any task raises
+        an exception, all waiting tasks are cancelled and the exception is
+        raised again without waiting for the tasks that are still running.
+        """
+        amount_tasks = sum(len(stems) for stems in stems_per_instrument)
+        amount_tasks += len(files) + 1
+        unfinished_stems = [len(stems) for stems in stems_per_instrument]
+        unfinished_mixes = len(files)
+        executor = Score.mk_executor(jobs)
+        # future -> (instrument_idx, file_name, is_stem)
+        running_tasks = {}
+
+        def submit_mix(instrument_idx) -> None:
+            stems = stems_per_instrument[instrument_idx]
+            file_name = files[instrument_idx]
+            inputdata = tuple((stem[0], stem[3]) for stem in stems)
+            future = executor.submit(
+                Score.mix_stems, file_name, inputdata, sectioned, profile
+            )
+            running_tasks[future] = (instrument_idx, file_name, False)
+
+        def submit_final_mix() -> None:
+            input_data = tuple((n,) + mixinfo for n, mixinfo in zip(files, mix_data))
+            future = executor.submit(
+                sound.mix_complex, name, *input_data, profile=profile
+            )
+            running_tasks[future] = (None, name, False)
+
+        try:
+            for instrument_idx, stems in enumerate(stems_per_instrument):
+                for file_name, cadence, se, _, _ in stems:
+                    future = executor.submit(
+                        Score.render_stem, file_name, cadence, se, stem_cache
+                    )
+                    running_tasks[future] = (instrument_idx, file_name, True)
+                if not stems:
+                    submit_mix(instrument_idx)
+            if not files:
+                submit_final_mix()
+
+            amount_finished_tasks = 0
+            while running_tasks:
+                finished, _ = concurrent.futures.wait(
+                    running_tasks, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    instrument_idx, file_name, is_stem = running_tasks.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        raise exception
+                    amount_finished_tasks += 1
+                    print(
+                        "[{0}/{1}] rendered {2}".format(
+                            amount_finished_tasks, amount_tasks, file_name
+                        )
+                    )
+                    if is_stem:
+                        unfinished_stems[instrument_idx] -= 1
+                        if unfinished_stems[instrument_idx] == 0:
+                            submit_mix(instrument_idx)
+                    elif instrument_idx is not None:
+                        unfinished_mixes -= 1
+                        if unfinished_mixes == 0:
+                            submit_final_mix()
+        except BaseException:
+            # running stems can take hours, therefore only the waiting tasks
+            # are cancelled and the running tasks aren't awaited
+            for waiting_future in running_tasks:
+                waiting_future.cancel()
+            executor.shutdown(wait=False)
+            raise
+        executor.shutdown()
+
+    def mk_build_graph(
+        self,
+        cache: bool = True,
+        preview: bool = False,
+        profile: sound.RenderProfile = sound.FINAL,
+        sectioned: bool = False,
+        instruments: tuple = None,
+        sections: tuple = None,
+        outputs: tuple = ("notation", "sound"),
+    ) -> build.Graph:
+        """Return build graph of notation and sound outputs.
+
+        The graph consists of the following nodes:
+
+            section/SECTION -> mdc/INSTRUMENT/SECTION_IDX
+            mdc/... -> notation/DOCUMENT (pdf)
+            mdc/... -> sound/INSTRUMENT/STEM -> sound/INSTRUMENT/INSTRUMENT
+                -> sound/SCORE
+
+        The key of a notation node is the generated LaTeX source, the key of a
+        stem is the key of the stem in the StemCache. Only the nodes of the
+        outputs ('notation' and / or 'sound') are added, so that a graph for
+        notation doesn't need any sound synthesis data and vice versa. Every
+        other argument has the same meaning as in render_sound.
+        """
+
+        def mk_mdc_node(name, mdc, section_node) -> build.Node:
+            data = functools.partial(repr, mdc)
+            return build.Node(name, data, (section_node,))
+
+        instrument_indices = Score.mk_instrument_indices(instruments)
+        section_indices = self.mk_section_indices(sections)
+
+        # section_idx -> mdc node for every instrument
+        mdc_nodes_per_instrument = [{} for i in instrument_indices]
+        mdc_nodes_gong_tong = []
+        for sec_idx in section_indices:
+            section = self.__sections[sec_idx]
+            section_node = build.Node(
+                "section/{0}".format(section[0]), repr((section[0], section[2]))
+            )
+            for mdc_nodes, ins_idx in zip(mdc_nodes_per_instrument, instrument_indices):
+                name = "mdc/{0}/{1}".format(
+                    Score.SIMPLIFIED_INSTRUMENTS[ins_idx].name, sec_idx
+                )
+                mdc_nodes[sec_idx] = mk_mdc_node(
+                    name, section[1][ins_idx], section_node
+                )
+            for name, mdc in (
+                ("gong", self.mdc_gong_per_sec[sec_idx]),
+                ("tong", self.mdc_tong_per_sec[sec_idx]),
+            ):
+                name = "mdc/{0}/{1}".format(name, sec_idx)
+                mdc_nodes_gong_tong.append(mk_mdc_node(name, mdc, section_node))
+
+        nodes = []
+        if "notation" in outputs:
+            directory = "output/notation/"
+
+            def mk_latex(ins_idx) -> str:
+                return self.mk_document(ins_idx, section_indices).mk_document().dumps()
+
+            def render(ins_idx) -> None:
+                doc = self.mk_document(ins_idx, section_indices)
+                Score.render_document(doc, directory)
+
+            for ins_idx, mdc_nodes in zip(instrument_indices, mdc_nodes_per_instrument):
+                # documents are only made if their key is needed
+                name = self.mk_document_name(ins_idx, section_indices)
+                nodes.append(
+                    build.Node(
+                        "notation/{0}".format(name),
+                        functools.partial(mk_latex, ins_idx),
+                        tuple(mdc_nodes.values()) + tuple(mdc_nodes_gong_tong),
+                        functools.partial(render, ins_idx),
+                        ("{0}{1}.pdf".format(directory, name),),
+                    )
+                )
+
+        if "sound" in outputs:
+            nodes.extend(
+                self.mk_sound_nodes(
+                    cache,
+                    preview,
+                    profile,
+                    sectioned,
+                    instrument_indices,
+                    section_indices,
+                    mdc_nodes_per_instrument,
+                )
+            )
+        return build.Graph(nodes, "output/build.json")
+
+    def mk_sound_nodes(
+        self,
+        cache: bool,
+        preview: bool,
+        profile: sound.RenderProfile,
+        sectioned: bool,
+        instrument_indices: tuple,
+        section_indices: tuple,
+        mdc_nodes_per_instrument: tuple,
+    ) -> tuple:
+        """Return stem, instrument mix and score mix nodes (see mk_build_graph)."""
+        if cache:
+            stem_cache = sound.StemCache("output/cache/")
+        else:
+            stem_cache = None
+
+        directory = "output/sound/"
+        stems_per_instrument, files = self.mk_stems(
+            directory, preview, profile, sectioned, instrument_indices, section_indices
+        )
+        nodes = []
+        mix_nodes = []
+        for stems, file_name, mdc_nodes in zip(
+            stems_per_instrument, files, mdc_nodes_per_instrument
+        ):
+            stem_nodes = []
+            for stem_name, cadence, se, _, section_idx in stems:
+                if sectioned:
+                    dependencies = (mdc_nodes[section_idx],)
+                else:
+                    dependencies = tuple(mdc_nodes.values())
+                stem_nodes.append(
+                    build.Node(
+                        "sound/{0}".format(stem_name[len(directory) :]),
+                        functools.partial(sound.StemCache.mk_key, cadence, se),
+                        dependencies,
+                        functools.partial(
+                            Score.render_stem, stem_name, cadence, se, stem_cache
+                        ),
+                        ("{0}.wav".format(stem_name),),
+                    )
+                )
+            inputdata = tuple((stem[0], stem[3]) for stem in stems)
+            mix_nodes.append(
+                build.Node(
+                    "sound/{0}".format(file_name[len(directory) :]),
+                    repr((inputdata, sectioned, profile.config)),
+                    stem_nodes,
+                    functools.partial(
+                        Score.mix_stems, file_name, inputdata, sectioned, profile
+                    ),
+                    ("{0}.wav".format(file_name),),
+                )
+            )
+            nodes.extend(stem_nodes)
+        nodes.extend(mix_nodes)
+
+        name = "{0}{1}".format(self.name, self.mk_suffix(section_indices))
+        res = "{0}{1}".format(directory, name)
+        mix_data = self.mk_mix_data(instrument_indices)
+        input_data = tuple((n,) + mixinfo for n, mixinfo in zip(files, mix_data))
+        nodes.append(
+            build.Node(
+                "sound/{0}".format(name),
+                repr((input_data, profile.config)),
+                mix_nodes,
+                functools.partial(sound.mix_complex, res, *input_data, profile=profile),
+                ("{0}.wav".format(res),),
+            )
+        )
+        return tuple(nodes)
+
+    def build(
+        self,
+        targets: tuple = None,
+        jobs: int = None,
+        dry_run: bool = False,
+        cache: bool = True,
+        preview: bool = False,
+        profile: sound.RenderProfile = sound.FINAL,
+        sectioned: bool = False,
+        instruments: tuple = None,
+        sections: tuple = None,
+    ) -> tuple:
+        """Build all stale outputs that are needed for targets.
+
+        Targets are names of nodes of the build graph (see mk_build_graph),
+        for instance ('notation',) for all documents, ('sound',) for all
+        soundfiles or ('sound/siter_gong',) for all soundfiles of one
+        instrument. If targets is None, all outputs are built. Return the
+        names of all stale nodes; if dry_run is True, they are only printed.
+
+        If all targets are notation (or sound) targets, no sound synthesis
+        data (or notation) is made. instruments and sections have the same
+        meaning as in render_sound.
+        """
+        outputs = ("notation", "sound")
+        if targets is not None:
+            prefixes = set(target.split("/")[0] for target in targets)
+            selected_outputs = tuple(o for o in outputs if o in prefixes)
+            if selected_outputs:
+                outputs = selected_outputs
+        graph = self.mk_build_graph(
+            cache, preview, profile, sectioned, instruments, sections, outputs
+        )
+        nodes = graph.build(targets, jobs, dry_run)
+        if dry_run:
+            for node in nodes:
+                print(node.name)
+        return tuple(node.name for node in nodes)
+
+
+class MDCCache(object):
+    """Bounded LRU cache for MDC objects that are made by MDC.mk_mdc_by_cadence.
+
+    The key of a MDC consists of the pitches, delays and durations of all events
+    of its cadence, the sizes of all units of its TimeFlow (per compound and
+    metre), the time level and is_pitch_sustained. Since MDC objects are
+    immutable, the cached objects are returned directly.
+    """
+
+    CacheInfo = collections.namedtuple(
+        "CacheInfo", ("hits", "misses", "maxsize", "currsize")
+    )
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.__maxsize = maxsize
+        self.__mdc_per_key = collections.OrderedDict()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self.__maxsize
+
+    def __len__(self) -> int:
+        return len(self.__mdc_per_key)
+
+    @staticmethod
+    def mk_key(
+        cadence: old.Cadence,
+        time_flow: metre.TimeFlow,
+        time_lv: int,
+        is_pitch_sustained: bool,
+    ) -> tuple:
+        def mk_pitch_key(pitch):
+            if type(pitch) == ji.JIHarmony:
+                return frozenset(pitch)
+            elif pitch == mel.TheEmptyPitch:
+                return None
+            try:
+                hash(pitch)
+                return pitch
+            except TypeError:
+                return repr(pitch)
+
+        events = tuple(
+            (mk_pitch_key(event.pitch), event.delay, event.duration)
+            for event in cadence
+        )
+        time_flow_signature = tuple(
+            tuple(compound_item.unit_size for compound_item in metre_item.compound)
+            for metre_item in time_flow.metre
+        )
+        return (events, time_flow_signature, time_lv, bool(is_pitch_sustained))
+
+    def get(self, key: tuple):
+        """Return cached MDC or None if there isn't any MDC for key."""
+        mdc = self.__mdc_per_key.get(key)
+        if mdc is None:
+            self.__misses += 1
+        else:
+            self.__hits += 1
+            self.__mdc_per_key.move_to_end(key)
+        return mdc
+
+    def set(self, key: tuple, mdc) -> None:
+        self.__mdc_per_key[key] = mdc
+        self.__mdc_per_key.move_to_end(key)
+        while len(self.__mdc_per_key) > self.maxsize:
+            self.__mdc_per_key.popitem(last=False)
+
+    def clear(self) -> None:
+        self.__mdc_per_key.clear()
+        self.__hits = 0
+        self.__misses = 0
+
+    def cache_info(self) -> "MDCCache.CacheInfo":
+        return MDCCache.CacheInfo(
+            self.__hits, self.__misses, self.maxsize, len(self.__mdc_per_key)
+        )
 
 
 class MDC(object):
-    """"Metre-divided Cadence (MDC).
+    """ "Metre-divided Cadence (MDC).
 
     MDC describes a cadence that is hierarchically divided by the structure of a
     nongkrong.metre.TimeFlow object. This structure can be sketched down as:
@@ -383,6 +1011,9 @@ class MDC(object):
     two elements won't be played legato but with an interruption.
     """
 
+    # MDC objects that have been made by mk_mdc_by_cadence
+    cache = MDCCache()
+
     def __init__(self, structure: tuple, is_pitch_sustained: bool = False):
         self.__is_pitch_sustained = is_pitch_sustained
         self.__structure = structure
@@ -395,6 +1026,11 @@ class MDC(object):
         time_lv: int = 0,
         is_pitch_sustained: bool = False,
     ):
+        key = (cls,) + MDCCache.mk_key(cadence, time_flow, time_lv, is_pitch_sustained)
+        mdc = MDC.cache.get(key)
+        if mdc is not None:
+            return mdc
+
         cadence = cadence.copy()
         # testing if input is valid
         MDC.is_valid_time_lv(time_lv)
@@ -405,7 +1041,9 @@ class MDC(object):
         structure = cls.convert_input2structure(
             cadence, time_flow, time_lv, is_pitch_sustained
         )
-        return cls(structure, is_pitch_sustained)
+        mdc = cls(structure, is_pitch_sustained)
+        MDC.cache.set(key, mdc)
+        return mdc
 
     @staticmethod
     def is_valid_time_lv(time_lv: int) -> None:
@@ -468,46 +1106,67 @@ class MDC(object):
     def divide_cadence_by_groups(
         cadence: old.Cadence, groups: tuple, is_pitch_sustained
     ) -> tuple:
-        def divide_recursively(
-            remaining_cadence, remaining_groups, divided_cadences: list = []
-        ) -> list:
-            if remaining_cadence:
-                new_cadence = type(remaining_cadence)([])
-                surplus_element = None
-                group_size = remaining_groups[0]
-                acc = 0
-                for idx, item in enumerate(remaining_cadence):
-                    size = float(item.delay)
-                    acc += size
-                    if acc == group_size:
-                        new_cadence.append(item)
-                        break
-                    elif acc < group_size:
-                        new_cadence.append(item)
-                    elif acc > group_size:
-                        diff = acc - group_size
-                        item0 = item.copy()
-                        item0.delay -= diff
-                        item0.duration -= diff
-                        item1 = item.copy()
-                        item1.delay = diff
-                        item1.duration = diff
-                        if is_pitch_sustained is False:
-                            item1.pitch = ji.JIHarmony([])
+        """Divide cadence in consecutive cadences with the durations of groups.
+
+        The end of every item and of every group is computed once (prefix sums),
+        the last item of a group is found with a binary search. Items that are
+        longer than the rest of their group are split. If is_pitch_sustained is
+        False, the second part becomes a rest.
+        """
+
+        def split(item, diff) -> tuple:
+            item0 = item.copy()
+            item0.delay -= diff
+            item0.duration -= diff
+            item1 = item.copy()
+            item1.delay = diff
+            item1.duration = diff
+            if is_pitch_sustained is False:
+                item1.pitch = ji.JIHarmony([])
+            return item0, item1
+
+        items = tuple(cadence)
+        endings = tuple(itertools.accumulate(float(item.delay) for item in items))
+        cadence_type = type(cadence)
+        divided_cadences = []
+        # index of the next item and the second part of the last split item
+        item_idx = 0
+        surplus_element = None
+        group_idx = 0
+        group_end = 0
+        while item_idx < len(items) or surplus_element is not None:
+            group_size = groups[group_idx]
+            group_idx += 1
+            group_end += group_size
+            new_cadence = []
+            if surplus_element is not None:
+                size = float(surplus_element.delay)
+                if size >= group_size:
+                    if size == group_size:
+                        new_cadence.append(surplus_element)
+                        surplus_element = None
+                    else:
+                        item0, surplus_element = split(
+                            surplus_element, size - group_size
+                        )
                         new_cadence.append(item0)
-                        surplus_element = item1
-                        break
-                divided_cadences.append(new_cadence)
-                remaining_cadence = remaining_cadence[idx + 1 :]
-                if surplus_element is not None:
-                    remaining_cadence.insert(0, surplus_element)
-                return divide_recursively(
-                    remaining_cadence, remaining_groups[1:], divided_cadences
-                )
+                    divided_cadences.append(cadence_type(new_cadence))
+                    continue
+                new_cadence.append(surplus_element)
+                surplus_element = None
+            last_idx = bisect.bisect_left(endings, group_end, item_idx)
+            if last_idx == len(items):
+                new_cadence.extend(items[item_idx:])
+            elif endings[last_idx] == group_end:
+                new_cadence.extend(items[item_idx : last_idx + 1])
             else:
-                return divided_cadences
-
-        return tuple(divide_recursively(cadence, groups, []))
+                new_cadence.extend(items[item_idx:last_idx])
+                diff = endings[last_idx] - group_end
+                item0, surplus_element = split(items[last_idx], diff)
+                new_cadence.append(item0)
+            item_idx = last_idx + 1
+            divided_cadences.append(cadence_type(new_cadence))
+        return tuple(divided_cadences)
 
     @staticmethod
     def divide_unit_by_elements(cadence, is_pitch_sustained) -> tuple:
@@ -588,58 +1247,59 @@ class MDC(object):
     def convert2cadence(
         self, tempo_factors_per_unit: tuple, delays: tuple
     ) -> old.JICadence:
-        """
-        """
-
-        def return_item_and_sizes(element, lv=0) -> tuple:
-            if type(element) == ji.JIHarmony or element == mel.TheEmptyPitch:
-                return ((element, lv),)
-            else:
-                ret = tuple([])
-                for tup in (return_item_and_sizes(it, lv + 1) for it in element):
-                    ret += tup
-                return ret
+        """Convert MDC to a cadence with real time delays.
 
+        tempo_factors_per_unit contains the duration of every division of every
+        element of a unit (see tempo.TempoLine.convert2tempo_per_unit). The
+        duration of an event is the difference of two prefix sums of all
+        factors. delays adds a pause before a unit.
+        """
+        compact = self.convert2compact()
+        amount_units = compact.amount_units
         divisions_per_elements = int(tempo.TempoLine.divisions_per_element)
-        cadence = []
-        unit_count = 0
-        for meter in self.__structure:
-            for compound in meter:
-                for unit in compound:
-
-                    delay = delays[unit_count]
-                    if delay:
-                        if cadence:
-                            cadence[-1].delay += delay.duration
-                            cadence[-1].duration += delay.duration
-                        else:
-                            cadence.append(old.Rest(delay.duration))
-
-                    factors = tempo_factors_per_unit[unit_count]
-
-                    abstract_delays = []
-                    harmonies = []
-
-                    for element in unit:
-                        item_and_size_pairs = return_item_and_sizes(element)
-                        for pair in item_and_size_pairs:
-                            harmonies.append(pair[0])
-                            de = int(divisions_per_elements * (1 / (2 ** pair[1])))
-                            abstract_delays.append(de)
-
-                    real_delays = tuple(itertools.accumulate([0] + abstract_delays))
-                    real_delays = tuple(
-                        sum(factors[idx0:idx1])
-                        for idx0, idx1 in zip(real_delays, real_delays[1:])
-                    )
-
-                    for h, de in zip(harmonies, real_delays):
-                        if h:
-                            cadence.append(old.Chord(h, de))
-                        else:
-                            cadence.append(old.Rest(de))
-
-                    unit_count += 1
+        factors_per_unit = tuple(tempo_factors_per_unit[i] for i in range(amount_units))
+        unit_sizes = np.array(tuple(len(f) for f in factors_per_unit), dtype=int)
+        unit_offsets = np.concatenate(((0,), np.cumsum(unit_sizes)))
+        factors = np.concatenate(
+            tuple(np.asarray(f, dtype=float) for f in factors_per_unit) + ((),)
+        )
+        prefix_sums = np.concatenate(((0,), np.cumsum(factors)))
+
+        unit_per_leaf = np.repeat(np.arange(amount_units), np.diff(compact.unit_starts))
+        starts = (compact.offset * divisions_per_elements) // compact.resolution
+        ends = starts + (divisions_per_elements >> compact.depth.astype(int))
+        # like slicing the factors of the unit
+        unit_size_per_leaf = unit_sizes[unit_per_leaf]
+        starts = np.minimum(starts, unit_size_per_leaf)
+        ends = np.minimum(ends, unit_size_per_leaf)
+        unit_offset_per_leaf = unit_offsets[unit_per_leaf]
+        real_delays = (
+            prefix_sums[unit_offset_per_leaf + ends]
+            - prefix_sums[unit_offset_per_leaf + starts]
+        ).tolist()
+
+        # delays before units are added to the event before the unit
+        first_rest = None
+        for unit_idx in range(amount_units):
+            delay = delays[unit_idx]
+            if delay:
+                previous_leaf = compact.unit_starts[unit_idx] - 1
+                if previous_leaf >= 0:
+                    real_delays[previous_leaf] += delay.duration
+                elif first_rest is None:
+                    first_rest = old.Rest(delay.duration)
+                else:
+                    first_rest.delay += delay.duration
+                    first_rest.duration += delay.duration
+
+        harmonies = compact.harmonies
+        is_chord = tuple(bool(h) for h in harmonies)
+        cadence = [] if first_rest is None else [first_rest]
+        for harmony_idx, de in zip(compact.harmony.tolist(), real_delays):
+            if is_chord[harmony_idx]:
+                cadence.append(old.Chord(harmonies[harmony_idx], de))
+            else:
+                cadence.append(old.Rest(de))
 
         cadence = old.JICadence(cadence).discard_rests()
         return cadence
@@ -648,6 +1308,11 @@ class MDC(object):
     def is_pitch_sustained(self) -> bool:
         return self.__is_pitch_sustained
 
+    def convert2compact(self) -> "CompactMDC":
+        return CompactMDC.mk_compact_mdc_by_structure(
+            self.__structure, self.is_pitch_sustained
+        )
+
     def __repr__(self) -> str:
         return str(self.__structure)
 
@@ -734,3 +1399,200 @@ class MDC(object):
                 se_numbers.append(se_number)
             decomposition.update({pitch: tuple(se_numbers)})
         return (self.divide_by_decomposition(decomposition), uniqfied_sound_engines)
+
+
+class CompactMDC(object):
+    """Flat representation of a MDC.
+
+    Every leaf of the structure of a MDC (a harmony or a rest) is one entry of
+    the following arrays:
+
+        metre, compound, unit -> position of the unit of the leaf
+        offset -> start of the leaf in its unit (in 1/resolution elements)
+        depth -> how often the element of the leaf has been divided
+        harmony -> index of the harmony of the leaf in harmonies
+
+    harmonies[0] is always mel.TheEmptyPitch (rests). Equal harmonies share
+    the same index. The leaves of the n-th unit of the MDC are
+    leaves[unit_starts[n] : unit_starts[n + 1]], so every unit can be accessed
+    in constant time. unit_positions contains (metre, compound, unit) of every
+    unit.
+    """
+
+    resolution = 16
+
+    def __init__(
+        self,
+        harmonies: tuple,
+        metre: np.ndarray,
+        compound: np.ndarray,
+        unit: np.ndarray,
+        offset: np.ndarray,
+        depth: np.ndarray,
+        harmony: np.ndarray,
+        unit_starts: np.ndarray,
+        unit_positions: np.ndarray,
+        is_pitch_sustained: bool = False,
+    ):
+        self.__harmonies = harmonies
+        self.__metre = metre
+        self.__compound = compound
+        self.__unit = unit
+        self.__offset = offset
+        self.__depth = depth
+        self.__harmony = harmony
+        self.__unit_starts = unit_starts
+        self.__unit_positions = unit_positions
+        self.__is_pitch_sustained = is_pitch_sustained
+
+    @classmethod
+    def mk_compact_mdc_by_structure(cls, structure: tuple, is_pitch_sustained: bool):
+        max_depth = int(np.log2(cls.resolution))
+        harmonies = [mel.TheEmptyPitch]
+        harmony_idx_per_harmony = {}
+        leaves = []
+        unit_starts = [0]
+        unit_positions = []
+
+        def add_leaves(element, position: tuple, offset: int, depth: int) -> None:
+            if type(element) == ji.JIHarmony or element == mel.TheEmptyPitch:
+                if type(element) == ji.JIHarmony:
+                    key = frozenset(element)
+                    harmony_idx = harmony_idx_per_harmony.get(key)
+                    if harmony_idx is None:
+                        harmony_idx = len(harmonies)
+                        harmony_idx_per_harmony[key] = harmony_idx
+                        harmonies.append(element)
+                else:
+                    harmony_idx = 0
+                leaves.append(position + (offset, depth, harmony_idx))
+            elif depth == max_depth:
+                msg = "Elements can't be divided more than {0} times.".format(max_depth)
+                raise ValueError(msg)
+            elif len(element) != 2:
+                msg = "Divided element {0} has to contain two items.".format(element)
+                raise ValueError(msg)
+            else:
+                size = cls.resolution >> (depth + 1)
+                for idx, item in enumerate(element):
+                    add_leaves(item, position, offset + (idx * size), depth + 1)
+
+        for metre_idx, metre in enumerate(structure):
+            for compound_idx, compound in enumerate(metre):
+                for unit_idx, unit in enumerate(compound):
+                    position = (metre_idx, compound_idx, unit_idx)
+                    for element_idx, element in enumerate(unit):
+                        add_leaves(element, position, element_idx * cls.resolution, 0)
+                    unit_starts.append(len(leaves))
+                    unit_positions.append(position)
+
+        columns = tuple(zip(*leaves)) if leaves else ((),) * 6
+        dtypes = (np.int32, np.int32, np.int32, np.int32, np.int8, np.int32)
+        arrays = tuple(np.array(c, dtype=dt) for c, dt in zip(columns, dtypes))
+        return cls(
+            tuple(harmonies),
+            *arrays,
+            np.array(unit_starts, dtype=np.int64),
+            np.array(unit_positions, dtype=np.int32).reshape(-1, 3),
+            is_pitch_sustained=is_pitch_sustained,
+        )
+
+    @property
+    def harmonies(self) -> tuple:
+        return self.__harmonies
+
+    @property
+    def metre(self) -> np.ndarray:
+        return self.__metre
+
+    @property
+    def compound(self) -> np.ndarray:
+        return self.__compound
+
+    @property
+    def unit(self) -> np.ndarray:
+        return self.__unit
+
+    @property
+    def offset(self) -> np.ndarray:
+        return self.__offset
+
+    @property
+    def depth(self) -> np.ndarray:
+        return self.__depth
+
+    @property
+    def harmony(self) -> np.ndarray:
+        return self.__harmony
+
+    @property
+    def unit_starts(self) -> np.ndarray:
+        return self.__unit_starts
+
+    @property
+    def unit_positions(self) -> np.ndarray:
+        return self.__unit_positions
+
+    @property
+    def is_pitch_sustained(self) -> bool:
+        return self.__is_pitch_sustained
+
+    @property
+    def amount_units(self) -> int:
+        return len(self.unit_starts) - 1
+
+    @property
+    def size(self) -> np.ndarray:
+        """Length of every leaf (in 1/resolution elements)."""
+        return self.resolution >> self.depth.astype(np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.metre, self.compound, self.unit, self.offset, self.depth)
+        arrays += (self.harmony, self.unit_starts, self.unit_positions)
+        return sum(array.nbytes for array in arrays)
+
+    def __len__(self) -> int:
+        return len(self.harmony)
+
+    def __repr__(self) -> str:
+        return "CompactMDC({0} units, {1} leaves)".format(self.amount_units, len(self))
+
+    def unit_slice(self, unit_idx: int) -> slice:
+        """Return slice of the leaves of the unit with index unit_idx."""
+        return slice(self.unit_starts[unit_idx], self.unit_starts[unit_idx + 1])
+
+    def convert_unit2structure(self, unit_idx: int) -> tuple:
+        leaves = self.unit_slice(unit_idx)
+        depths = self.depth[leaves].tolist()
+        harmony_indices = self.harmony[leaves].tolist()
+        leaf_idx = 0
+
+        def mk_element(depth: int):
+            nonlocal leaf_idx
+            if depths[leaf_idx] == depth:
+                leaf_idx += 1
+                return self.harmonies[harmony_indices[leaf_idx - 1]]
+            return (mk_element(depth + 1), mk_element(depth + 1))
+
+        elements = []
+        while leaf_idx < len(depths):
+            elements.append(mk_element(0))
+        return tuple(elements)
+
+    def convert2structure(self) -> tuple:
+        """Return the nested tuple structure of the equivalent MDC."""
+        structure = []
+        for unit_idx, position in enumerate(self.unit_positions.tolist()):
+            metre_idx, compound_idx, _ = position
+            if metre_idx == len(structure):
+                structure.append([])
+            if compound_idx == len(structure[-1]):
+                structure[-1].append([])
+            structure[-1][-1].append(self.convert_unit2structure(unit_idx))
+        return tuple(
+            tuple(tuple(compound) for compound in metre) for metre in structure
+        )
+
+    def convert2mdc(self) -> MDC:
+        return MDC(self.convert2structure(), self.is_pitch_sustained)
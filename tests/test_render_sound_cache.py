@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mu.mel import ji
+from mu.sco import old
+
+from nongkrong.render.sound import cache
+from nongkrong.render.sound.synthesis import synthesis
+
+
+class CountingEngine(object):
+    config = ("CountingEngine",)
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, name, cadence) -> None:
+        self.calls += 1
+        with open("{0}.wav".format(name), "wb") as f:
+            f.write(b"0" * 10 * len(cadence))
+
+
+class StemCacheTest(unittest.TestCase):
+    def test_render(self):
+        cadence0 = old.JICadence([old.Chord(ji.JIHarmony([ji.r(1, 1)]), 1)])
+        cadence1 = old.JICadence([old.Chord(ji.JIHarmony([ji.r(3, 2)]), 1)] * 2)
+        engine = CountingEngine()
+        with tempfile.TemporaryDirectory() as directory:
+            stem_cache = cache.StemCache(os.path.join(directory, "cache"), 25)
+            name = os.path.join(directory, "stem")
+            self.assertFalse(stem_cache.render(name, cadence0, engine))
+            self.assertTrue(stem_cache.render(name, cadence0, engine))
+            self.assertEqual(engine.calls, 1)
+            self.assertTrue(os.path.exists("{0}.wav".format(name)))
+            # the second soundfile exceeds max_bytes, the first one gets removed
+            self.assertFalse(stem_cache.render(name, cadence1, engine))
+            self.assertFalse(stem_cache.render(name, cadence0, engine))
+            self.assertEqual(engine.calls, 3)
+
+    def test_store(self):
+        cadence = old.JICadence([old.Chord(ji.JIHarmony([ji.r(1, 1)]), 1)])
+        engine = CountingEngine()
+        with tempfile.TemporaryDirectory() as directory:
+            stem_cache = cache.StemCache(os.path.join(directory, "cache"))
+            name = os.path.join(directory, "stem")
+            path = stem_cache.path(cache.StemCache.mk_key(cadence, engine))
+            stem_cache.render(name, cadence, engine)
+            self.assertTrue(os.path.samefile(path, "{0}.wav".format(name)))
+            self.assertEqual(os.listdir(stem_cache.directory), [os.path.basename(path)])
+            # without hard links the soundfile gets copied
+            os.remove(path)
+            with mock.patch.object(cache.os, "link", side_effect=OSError):
+                stem_cache.store(cache.StemCache.mk_key(cadence, engine), name)
+            self.assertFalse(os.path.samefile(path, "{0}.wav".format(name)))
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"0" * 10)
+
+    def test_fetch_evicted_soundfile(self):
+        cadence = old.JICadence([old.Chord(ji.JIHarmony([ji.r(1, 1)]), 1)])
+        engine = CountingEngine()
+        with tempfile.TemporaryDirectory() as directory:
+            stem_cache = cache.StemCache(os.path.join(directory, "cache"))
+            name = os.path.join(directory, "stem")
+            stem_cache.render(name, cadence, engine)
+            key = cache.StemCache.mk_key(cadence, engine)
+            link = os.link
+
+            def evict_and_link(source, target):
+                # another process evicts the soundfile just before it gets linked
+                os.remove(source)
+                link(source, target)
+
+            with mock.patch.object(cache.os, "link", evict_and_link):
+                self.assertFalse(stem_cache.fetch(key, name))
+            self.assertFalse(stem_cache.render(name, cadence, engine))
+            self.assertEqual(engine.calls, 2)
+
+    def test_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            fxp = os.path.join(directory, "test.fxp")
+            with open(fxp, "w") as f:
+                f.write("0")
+            engine = synthesis.PyteqEngine(fxp=fxp)
+            config = engine.config
+            with open(fxp, "w") as f:
+                f.write("00")
+            self.assertNotEqual(engine.config, config)
+            engine.VERSION += 1
+            self.assertNotEqual(engine.config, synthesis.PyteqEngine(fxp=fxp).config)
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from nongkrong.render.sound import mix
+from nongkrong.render.sound import wav
+
+
+class WavTest(unittest.TestCase):
+    def test_write_and_read(self):
+        signal = np.linspace(-0.5, 0.5, 301).reshape(-1, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "test.wav")
+            for sample_format, tolerance in (("int16", 2**-15), ("double", 0)):
+                with wav.WavWriter(name, 44100, 1, sample_format) as writer:
+                    writer.write(signal[:100])
+                    writer.write(signal[100:])
+                reader = wav.WavReader(name)
+                self.assertEqual(reader.frames, 301)
+                self.assertEqual(reader.rate, 44100)
+                self.assertLessEqual(np.max(np.abs(reader.read() - signal)), tolerance)
+
+    def test_sample_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "test.wav")
+            index_name = os.path.join(directory, "index.json")
+            with wav.WavWriter(name, 1000, 2) as writer:
+                writer.write(np.zeros((500, 2)))
+            sample_index = wav.SampleIndex(index_name)
+            self.assertEqual(sample_index.info(name), (0.5, 2, 1000, 500))
+            sample_index.save()
+            self.assertEqual(len(wav.SampleIndex(index_name)), 1)
+            with wav.WavWriter(name, 1000, 1) as writer:
+                writer.write(np.zeros(250))
+            os.utime(name, ns=(0, 0))
+            self.assertEqual(sample_index.duration(name), 0.25)
+
+
+class MixTest(unittest.TestCase):
+    def test_mix_complex(self):
+        signal0 = np.linspace(-0.5, 0.5, 1000)
+        signal1 = np.linspace(0.2, 0.4, 500)
+        with tempfile.TemporaryDirectory() as directory:
+            names = tuple(os.path.join(directory, str(i)) for i in range(3))
+            for name, signal in zip(names, (signal0, signal1)):
+                with wav.WavWriter("{0}.wav".format(name), 1000, 1) as writer:
+                    writer.write(signal)
+            mix.mix_complex(names[2], (names[0], 0.5, 0.25, 0), (names[1], 2, 1, 0.8))
+            result = wav.WavReader("{0}.wav".format(names[2])).read()
+        expected = np.zeros((1300, 2))
+        expected[:1000, 0] += signal0 * 0.5 * 0.75
+        expected[:1000, 1] += signal0 * 0.5 * 0.25
+        expected[800:, 1] += signal1 * 2
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_mix_sections(self):
+        signal = np.linspace(-0.5, 0.5, 300)
+        with tempfile.TemporaryDirectory() as directory:
+            names = tuple(os.path.join(directory, str(i)) for i in range(3))
+            for name in names[:2]:
+                with wav.WavWriter("{0}.wav".format(name), 1000, 1) as writer:
+                    writer.write(signal)
+            mix.mix_sections(names[2], (names[0], 0), (names[1], 0.25))
+            result = wav.WavReader("{0}.wav".format(names[2])).read()
+        expected = np.zeros((550, 1))
+        expected[:300, 0] += signal
+        expected[250:, 0] += signal
+        self.assertTrue(np.allclose(result, expected))
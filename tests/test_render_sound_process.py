@@ -0,0 +1,26 @@
+import os
+import sys
+import unittest
+
+from nongkrong.render.sound import process
+
+
+class ProcessTest(unittest.TestCase):
+    def test_workspace(self):
+        with process.workspace(keep=False) as path:
+            self.assertTrue(os.path.isdir(path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_run(self):
+        self.assertEqual(process.run((sys.executable, "-c", "print(1)")), "1\n")
+        cmd = (sys.executable, "-c", "import sys; sys.exit('broken')")
+        with self.assertRaises(process.RenderError) as context:
+            process.run(cmd)
+        self.assertEqual(context.exception.returncode, 1)
+        self.assertIn("broken", context.exception.stderr)
+
+    def test_timeout(self):
+        cmd = (sys.executable, "-c", "import time; time.sleep(5)")
+        with self.assertRaises(process.RenderError) as context:
+            process.run(cmd, timeout=0.1)
+        self.assertIsNone(context.exception.returncode)
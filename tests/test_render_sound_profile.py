@@ -0,0 +1,30 @@
+import unittest
+
+from nongkrong.render.sound import profile
+
+
+class RenderProfileTest(unittest.TestCase):
+    def test_csound_flags(self):
+        self.assertEqual(
+            profile.FINAL.csound_flags, ("--format=double", "-k", 96000, "-r", 96000)
+        )
+        self.assertEqual(
+            profile.DRAFT.csound_flags, ("--format=float", "-k", 4410, "-r", 44100)
+        )
+
+    def test_bit_depth(self):
+        self.assertEqual(profile.FINAL.bit_depth, 64)
+        self.assertEqual(profile.FINAL.pianoteq_bit_depth, 32)
+        self.assertEqual(profile.DRAFT.pianoteq_bit_depth, 32)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(
+            ValueError, profile.RenderProfile, "test", 44100, "int8", 0.001
+        )
+        self.assertRaises(
+            ValueError, profile.RenderProfile, "test", 44100, "float", 0.001, 13
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,274 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import mido
+import numpy as np
+
+from mu.mel import ji
+from mu.rhy import rhy
+from mu.sco import old
+
+from nongkrong.render.sound.synthesis import pyteq
+
+
+def mk_sequence() -> tuple:
+    pitches = (ji.r(1, 1), ji.r(3, 2), ji.r(5, 4), ji.r(7, 4))
+    return tuple(
+        pyteq.PyteqTone(ji.JIPitch(p, multiply=260), 0.5, 1, volume=0.7)
+        for p in pitches
+    ) + (old.Rest(0.5),)
+
+
+def mk_absolute_messages(track, ignore_pitch_bends: bool = False) -> tuple:
+    messages = []
+    tick = 0
+    for msg in track:
+        tick += msg.time
+        if not msg.is_meta and not (ignore_pitch_bends and msg.type == "pitchwheel"):
+            messages.append((tick, msg.copy(time=0)))
+    return tuple(messages)
+
+
+class MidiFileTest(unittest.TestCase):
+    def test_sparse_pitch_bends(self):
+        sparse = pyteq.MidiFile(mk_sequence()).miditrack.tracks[0]
+        dense = pyteq.MidiFile(mk_sequence(), sparse_pitch_bends=False)
+        dense = dense.miditrack.tracks[0]
+        self.assertEqual(sum(msg.type == "pitchwheel" for msg in sparse), 0)
+        self.assertEqual(
+            mk_absolute_messages(sparse), mk_absolute_messages(dense, True)
+        )
+
+    def test_pitch_bends_before_note_on(self):
+        # 16 successive tones: the last one reuses the channel of the bent tone
+        sequence = tuple(
+            pyteq.PyteqTone(ji.JIPitch(ji.r(n + 16, 16), multiply=260), 1, 1)
+            for n in range(16)
+        )
+        sequence[0].glissando = old.GlissandoLine(
+            old.InterpolationLine(
+                [
+                    old.PitchInterpolation(1, ji.r(33, 32)),
+                    old.PitchInterpolation(0, ji.r(33, 32)),
+                ]
+            )
+        )
+        messages = tuple(
+            (tick, msg.type)
+            for tick, msg in mk_absolute_messages(
+                pyteq.MidiFile(sequence).miditrack.tracks[0]
+            )
+            if msg.type in ("note_on", "pitchwheel") and msg.channel == 0
+        )
+        self.assertEqual(messages[:2], ((0, "pitchwheel"), (0, "note_on")))
+        self.assertEqual(messages[-2:], ((15000, "pitchwheel"), (15000, "note_on")))
+
+    def test_export(self):
+        midi_file = pyteq.MidiFile(mk_sequence())
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "test.mid")
+            midi_file.export(name)
+            track = mido.MidiFile(name).tracks[0]
+        self.assertEqual(tuple(track), tuple(midi_file.iter_events()))
+        self.assertEqual(tuple(track), tuple(midi_file.miditrack.tracks[0]))
+
+    def test_export2wav(self):
+        def run(cmd, cwd=None, timeout=None):
+            midi_name = cmd[cmd.index("--midi") + 1]
+            self.assertEqual(os.path.dirname(midi_name), cwd)
+            self.assertTrue(os.path.exists(midi_name))
+            self.assertEqual(
+                cmd[cmd.index("--wav") + 1], os.path.join(directory, "t.wav")
+            )
+            self.assertEqual(timeout, 10)
+            workspaces.append(cwd)
+
+        workspaces = []
+        pianoteq = pyteq.Pianoteq(mk_sequence())
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.object(pyteq.process, "run", side_effect=run):
+                pianoteq.export2wav(os.path.join(directory, "t"), timeout=10)
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(len(workspaces), 1)
+        self.assertFalse(os.path.exists(workspaces[0]))
+
+    def test_tuning_dump_positions(self):
+        sequence = (old.Rest(2),) + tuple(
+            pyteq.PyteqTone(ji.JIPitch(ji.r(n, 4), multiply=260), 1, 1)
+            for n in (4, 5, 6, 7)
+        )
+        midi_file = pyteq.MidiFile(sequence, tuning_dump_positions=(3,))
+        bulk_ticks = tuple(
+            tick
+            for tick, msg in mk_absolute_messages(midi_file.miditrack.tracks[0])
+            if msg.type == "sysex" and msg.data[5] > 1
+        )
+        self.assertIn(3000, bulk_ticks)
+        self.assertNotIn(5000, bulk_ticks)
+
+    def test_detect_pitch_bending_per_tone(self):
+        gridsize = 0.001
+        glissando = old.GlissandoLine(
+            old.InterpolationLine(
+                [
+                    old.PitchInterpolation(1, ji.r(8, 7)),
+                    old.PitchInterpolation(2, ji.r(1, 1)),
+                    old.PitchInterpolation(0, ji.r(1, 1)),
+                ]
+            )
+        )
+        vibrato = old.VibratoLine(
+            old.InterpolationLine(
+                [
+                    old.PitchInterpolation(2, ji.r(30, 29)),
+                    old.PitchInterpolation(0, ji.r(30, 29)),
+                ]
+            ),
+            old.InterpolationLine(
+                [
+                    old.PitchInterpolation(2, ji.r(30, 31)),
+                    old.PitchInterpolation(0, ji.r(30, 31)),
+                ]
+            ),
+            old.InterpolationLine(
+                [
+                    old.RhythmicInterpolation(2, rhy.RhyUnit(0.25)),
+                    old.RhythmicInterpolation(0, rhy.RhyUnit(0.25)),
+                ]
+            ),
+        )
+        pitch = ji.JIPitch(ji.r(1, 1), multiply=260)
+        sequence = (
+            pyteq.PyteqTone(pitch, 1, 1.5, glissando=glissando, vibrato=vibrato),
+            pyteq.PyteqTone(pitch, 1, 4, glissando=glissando),
+            pyteq.PyteqTone(pitch, 1, 1),
+        )
+        grid_position_per_tone = ((0, 1500), (1500, 5500), (5500, 6500))
+        pitch_bending = pyteq.MidiFile.detect_pitch_bending_per_tone(
+            sequence, gridsize, grid_position_per_tone, skip_unbended_tones=True
+        )
+
+        def resize(line, size: int) -> np.ndarray:
+            values = np.zeros(size)
+            interpolation = line.interpolate(gridsize)[:size]
+            values[: len(interpolation)] = interpolation
+            return values
+
+        # the curves are the interpolations of mu, cut or filled with zeros
+        expected = resize(glissando, 1500) + resize(vibrato, 1500)
+        np.testing.assert_allclose(pitch_bending[0], expected, rtol=0, atol=1e-9)
+        expected = resize(glissando, 4000)
+        np.testing.assert_allclose(pitch_bending[1], expected, rtol=0, atol=1e-9)
+        self.assertIsNone(pitch_bending[2])
+
+    def test_distribute_pitch_bend_changes_on_channels(self):
+        changes = pyteq.MidiFile.distribute_pitch_bend_changes_on_channels(
+            (None, (0, 0, 600, 600), None, None),
+            ((0, 4), (2, 6), (4, 5), (7, 8)),
+            (0, 1, 2, 1),
+        )
+        self.assertEqual(changes[0], tuple([]))
+        self.assertEqual(changes[1], ((4, 4096), (7, 0)))
+        self.assertEqual(changes[2], tuple([]))
+
+    def test_convert_cents2pitch_bends(self):
+        cents = (0, 0.01, -100, 350.5, 1200, -1200)
+        self.assertEqual(
+            tuple(pyteq.MidiFile.convert_cents2pitch_bends(cents)),
+            tuple(pyteq.MidiFile.convert_cents2pitch_bend(c) for c in cents),
+        )
+        self.assertRaises(Warning, pyteq.MidiFile.convert_cents2pitch_bends, (1300,))
+
+    def test_allocate_midi_keys(self):
+        pitch = ji.JIPitch(ji.r(1, 1), multiply=260)
+        sequence = (
+            pyteq.PyteqTone(pitch, 0, 1),
+            pyteq.PyteqTone(pitch, 0, 1),
+            pyteq.PyteqTone(pitch, 1, 1),
+            pyteq.PyteqTone(pitch, 1, 1),
+        )
+        available_midi_notes = tuple(range(128))
+        midi_keys_dict = pyteq.MidiFile.mk_midi_key_dictionary(
+            set([pitch]), available_midi_notes, len(available_midi_notes)
+        )
+        keys = pyteq.MidiFile.allocate_midi_keys(
+            sequence,
+            available_midi_notes,
+            midi_keys_dict,
+            pyteq.OverlapIndex(sequence),
+        )
+        self.assertEqual(keys, (59, 60, 58, 59))
+
+
+class ControllerStateTest(unittest.TestCase):
+    def test_update(self):
+        tone = pyteq.PyteqTone(
+            ji.JIPitch(ji.r(1, 1), multiply=260), 1, 1, strike_point=0.25, mute=1
+        )
+        controller_state = pyteq.ControllerState()
+        self.assertEqual(len(controller_state.update(tone.control_messages(0))), 2)
+        self.assertEqual(controller_state.update(tone.control_messages(0)), tuple([]))
+        self.assertEqual(len(controller_state.update(tone.control_messages(1))), 2)
+        tone.mute = 0
+        messages = controller_state.update(tone.control_messages(0))
+        self.assertEqual(tuple((m.control, m.value) for m in messages), ((36, 0),))
+
+
+class VoiceAllocatorTest(unittest.TestCase):
+    def test_allocate(self):
+        voice_allocator = pyteq.VoiceAllocator(
+            ((0, 4), (0, 2), (2, 3), (3, 4), (4, 5), (4, 6)), (0, 1, 2)
+        )
+        self.assertEqual(voice_allocator.channel_per_tone, (0, 1, 2, 1, 2, 0))
+        self.assertEqual(voice_allocator[4], 2)
+        self.assertEqual(voice_allocator.tones_per_channel(), ((0, 5), (1, 3), (2, 4)))
+
+    def test_reuse_earliest_ending_channel(self):
+        voice_allocator = pyteq.VoiceAllocator(((0, 4), (0, 2), (1, 3)), (0, 1))
+        self.assertEqual(voice_allocator.channel_per_tone, (0, 1, 1))
+
+
+class GridTest(unittest.TestCase):
+    def test_position(self):
+        grid = pyteq.Grid(10, 0.25)
+        self.assertEqual(len(grid), 40)
+        self.assertEqual(grid[-1], 9.75)
+        self.assertEqual(grid.position(1.1), 4)
+        self.assertEqual(grid.position(1.125), 5)
+        self.assertEqual(grid.position(100), 39)
+
+
+class OverlapIndexTest(unittest.TestCase):
+    def test_queries(self):
+        pitch = ji.JIPitch(ji.r(1, 1), multiply=260)
+        sequence = (
+            pyteq.PyteqTone(pitch, 0, 2),
+            pyteq.PyteqTone(pitch, 1, 1),
+            pyteq.PyteqTone(pitch, 1, 0.5),
+            pyteq.PyteqTone(pitch, 1, 1),
+        )
+        overlap_index = pyteq.OverlapIndex(sequence)
+        self.assertEqual(overlap_index.starts, (0, 0, 1, 2))
+        self.assertEqual(overlap_index.preceding(2), (0,))
+        self.assertEqual(overlap_index.overlapping(0), (1, 2))
+        self.assertEqual(overlap_index.overlapping(3), tuple([]))
+        self.assertEqual(overlap_index.sounding_at(0.5), (0, 1))
+        self.assertEqual(overlap_index.sounding_at(1.7), (0,))
+        self.assertEqual(overlap_index.sounding_at(3), tuple([]))
+
+
+class TuningStateTest(unittest.TestCase):
+    def test_retune(self):
+        tuning_state = pyteq.TuningState()
+        pairs = ((60, (60, 0, 0)), (61, (60, 0, 0)))
+        self.assertEqual(len(tuning_state.retune(pairs)), 2)
+        self.assertEqual(tuning_state.retune(pairs), tuple([]))
+        messages = tuning_state.retune(((60, (60, 0, 0)), (61, (61, 12, 0))))
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].data, (127, 127, 8, 2, 0, 1, 61, 61, 12, 0))
+        tuning_state.forget()
+        messages = tuning_state.retune(pairs, bulk=True)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].data[5:], (2, 60, 60, 0, 0, 61, 60, 0, 0))
@@ -0,0 +1,31 @@
+import unittest
+
+import numpy as np
+
+from nongkrong.render.sound.synthesis import reverb
+
+
+class FilterTest(unittest.TestCase):
+    def test_comb_filter(self):
+        signal = np.random.RandomState(0).normal(size=500)
+        expected = np.zeros(500)
+        for n in range(500):
+            delayed = expected[n - 7] if n >= 7 else 0
+            delayed_1 = expected[n - 8] if n >= 8 else 0
+            expected[n] = signal[n] + 0.8 * (0.7 * delayed + 0.3 * delayed_1)
+        comb = reverb.CombFilter(7, 0.8, 0.3)
+        result = np.concatenate(
+            (comb(signal[:100]), comb(signal[100:103]), comb(signal[103:]))
+        )
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_allpass_filter(self):
+        signal = np.random.RandomState(0).normal(size=500)
+        expected = np.zeros(500)
+        for n in range(500):
+            delayed = signal[n - 7] if n >= 7 else 0
+            delayed_output = expected[n - 7] if n >= 7 else 0
+            expected[n] = -0.5 * signal[n] + delayed + 0.5 * delayed_output
+        allpass = reverb.AllpassFilter(7)
+        result = np.concatenate((allpass(signal[:3]), allpass(signal[3:])))
+        self.assertTrue(np.allclose(result, expected))
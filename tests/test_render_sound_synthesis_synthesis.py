@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from mu.mel import ji
+from mu.sco import old
+
+from nongkrong.render.sound import profile
+from nongkrong.render.sound import wav
+from nongkrong.render.sound.synthesis import reverb
+from nongkrong.render.sound.synthesis import synthesis
+
+TEST_PROFILE = profile.RenderProfile("test", 1000, "double", 0.01)
+
+
+def write_sample(name: str, signal: np.ndarray, rate: int = 1000) -> None:
+    with wav.WavWriter(name, rate, 1) as writer:
+        writer.write(signal)
+
+
+class OverlapAddTest(unittest.TestCase):
+    def test_overlap_add(self):
+        signals = ((0, np.ones(5)), (3, np.full(6, 2.0)), (12, np.array((1.0, 2.0))))
+        expected = np.zeros(14)
+        for start, signal in signals:
+            expected[start : start + len(signal)] += signal
+        # the last signal is longer than the output
+        expected = expected[:13]
+        blocks = tuple(synthesis.overlap_add(iter(signals), 13, 4))
+        self.assertEqual(tuple(len(block) for block in blocks), (4, 4, 4, 1))
+        self.assertTrue(np.array_equal(np.concatenate(blocks), expected))
+
+
+class SamplePlaybackEngineTest(unittest.TestCase):
+    def test_resample(self):
+        signal = np.linspace(0, 0.5, 100)
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "sample.wav")
+            write_sample(name, signal)
+            mtime = os.stat(name).st_mtime_ns
+            resampled = synthesis.SamplePlaybackEngine.resample(name, mtime, 1, 1000)
+            self.assertTrue(np.allclose(resampled, signal))
+            # the result is always as long as the sample itself
+            resampled = synthesis.SamplePlaybackEngine.resample(name, mtime, 2, 1000)
+            self.assertEqual(len(resampled), 100)
+            self.assertTrue(np.allclose(resampled[:50], signal[::2]))
+            self.assertTrue(np.allclose(resampled[50:], 0))
+            resampled = synthesis.SamplePlaybackEngine.resample(name, mtime, 1, 2000)
+            self.assertEqual(len(resampled), 200)
+            self.assertTrue(np.allclose(resampled[::2], signal))
+
+    def test_render(self):
+        signal = np.sin(np.linspace(0, 20 * np.pi, 300)) * 0.5
+        pitch = ji.r(1, 1)
+        cadence = old.JICadence([old.Rest(0.5), old.Chord(ji.JIHarmony([pitch]), 1)])
+        with tempfile.TemporaryDirectory() as directory:
+            sample_name = os.path.join(directory, "sample.wav")
+            write_sample(sample_name, signal)
+            engine = synthesis.SamplePlaybackEngine({pitch: ((sample_name, 1, 0.5),)})
+            engine = engine.with_profile(TEST_PROFILE)
+            engine.block_size = 256
+            name = os.path.join(directory, "stem")
+            engine(name, cadence)
+            result = wav.WavReader("{0}.wav".format(name)).read()[:, 0]
+
+        send = np.zeros(6500)
+        send[500:800] = signal
+        expected = (send * 0.5) + reverb.Reverb(1000)(send * engine.reverb_send)
+        self.assertEqual(len(result), len(expected))
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_config(self):
+        engine = synthesis.SamplePlaybackEngine({})
+        self.assertNotIn(engine.orc, engine.config)
+        self.assertNotIn("csound", engine.config)
+
+
+class PreviewEngineTest(unittest.TestCase):
+    def test_mk_modes(self):
+        engine = synthesis.PreviewEngine().with_profile(TEST_PROFILE)
+        frequencies, amplitudes, decay_times = engine.mk_modes(100)
+        self.assertEqual(tuple(frequencies), (100, 200, 300, 400))
+        self.assertEqual(len(amplitudes), 4)
+        self.assertEqual(len(decay_times), 4)
+        engine = synthesis.PreviewEngine("bar").with_profile(TEST_PROFILE)
+        self.assertEqual(len(engine.mk_modes(100)[0]), 2)
+        self.assertEqual(len(engine.mk_modes(600)[0]), 0)
+
+    def test_synthesize(self):
+        engine = synthesis.PreviewEngine(volume=0.7).with_profile(TEST_PROFILE)
+        duration = 0.5
+        signal = engine.synthesize(50, duration)
+        self.assertLessEqual(len(signal), (duration + engine.release_time * 8) * 1000)
+        released = int((duration + engine.release_time * 5) * 1000)
+        self.assertGreater(np.abs(signal[:released]).max(), 0.1)
+        self.assertLess(np.abs(signal[released:]).max(), 0.7 * np.exp(-5))
+        # a fundamental above the nyquist frequency leads to silence
+        self.assertEqual(len(engine.synthesize(600, duration)), 0)
+
+    def test_render_silence(self):
+        engine = synthesis.PreviewEngine().with_profile(TEST_PROFILE)
+        cadence = old.JICadence([old.Chord(ji.JIHarmony([ji.r(3, 1)]), 1)])
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "stem")
+            engine(name, cadence)
+            result = wav.WavReader("{0}.wav".format(name)).read()
+        self.assertEqual(len(result), 6000)
+        self.assertFalse(np.any(result))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from nongkrong.score import build
+
+
+class GraphTest(unittest.TestCase):
+    def test_build(self):
+        calls = []
+
+        def mk_action(path):
+            def action():
+                calls.append(os.path.basename(path))
+                with open(path, "w") as f:
+                    f.write("")
+
+            return action
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = tuple(os.path.join(directory, n) for n in ("a", "b", "c"))
+            state_path = os.path.join(directory, "build.json")
+
+            def mk_graph(data_a):
+                source = build.Node("data/a", data_a)
+                node_a = build.Node("out/a", "", (source,), mk_action(paths[0]))
+                node_b = build.Node("out/b", "", (), mk_action(paths[1]), paths[1:2])
+                node_c = build.Node(
+                    "mix", "", (node_a, node_b), mk_action(paths[2]), paths[2:]
+                )
+                return build.Graph((node_c,), state_path)
+
+            graph = mk_graph("0")
+            self.assertEqual(len(graph.nodes), 4)
+            stale = tuple(n.name for n in graph.build(("out",), dry_run=True))
+            self.assertEqual(stale, ("out/a", "out/b"))
+            self.assertEqual(calls, [])
+            graph.build(jobs=2)
+            self.assertEqual(sorted(calls[:2]), ["a", "b"])
+            self.assertEqual(calls[2], "c")
+            self.assertEqual(mk_graph("0").stale(), tuple([]))
+            os.remove(paths[1])
+            self.assertEqual(tuple(n.name for n in mk_graph("0").stale()), ("out/b",))
+            stale = mk_graph("1").stale(("mix",))
+            self.assertEqual(tuple(n.name for n in stale), ("out/a", "out/b", "mix"))
+            self.assertRaises(KeyError, graph.stale, ("unknown",))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,89 @@
+import itertools
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
+
+import numpy as np
 
 from mu.sco import old
 from mu.mel import ji
 from mu.mel import mel
 
 from nongkrong.metre import metre
+from nongkrong.tempo import tempo
+from nongkrong.render import sound
+from nongkrong.render.sound import wav
+from nongkrong.score import build
 from nongkrong.score import score
 
 
+class StubEngine(object):
+    """Sound engine that writes a short soundfile after waiting delay seconds."""
+
+    def __init__(self, delay: float = 0, fail: bool = False) -> None:
+        self.delay = delay
+        self.fail = fail
+
+    def __call__(self, name: str, cadence) -> None:
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("Can't render {0}.".format(name))
+        with wav.WavWriter("{0}.wav".format(name), 1000, 1) as writer:
+            writer.write(np.full(100, 0.1))
+
+
+def convert2cadence_baseline(mdc, tempo_factors_per_unit, delays) -> old.JICadence:
+    """MDC.convert2cadence like it has been before the prefix sum rewrite."""
+
+    def return_item_and_sizes(element, lv=0) -> tuple:
+        if type(element) == ji.JIHarmony or element == mel.TheEmptyPitch:
+            return ((element, lv),)
+        else:
+            ret = tuple([])
+            for tup in (return_item_and_sizes(it, lv + 1) for it in element):
+                ret += tup
+            return ret
+
+    divisions_per_elements = int(tempo.TempoLine.divisions_per_element)
+    cadence = []
+    unit_count = 0
+    for meter in mdc:
+        for compound in meter:
+            for unit in compound:
+                delay = delays[unit_count]
+                if delay:
+                    if cadence:
+                        cadence[-1].delay += delay.duration
+                        cadence[-1].duration += delay.duration
+                    else:
+                        cadence.append(old.Rest(delay.duration))
+
+                factors = tempo_factors_per_unit[unit_count]
+                abstract_delays = []
+                harmonies = []
+                for element in unit:
+                    for pair in return_item_and_sizes(element):
+                        harmonies.append(pair[0])
+                        de = int(divisions_per_elements * (1 / (2 ** pair[1])))
+                        abstract_delays.append(de)
+
+                real_delays = tuple(itertools.accumulate([0] + abstract_delays))
+                real_delays = tuple(
+                    sum(factors[idx0:idx1])
+                    for idx0, idx1 in zip(real_delays, real_delays[1:])
+                )
+                for h, de in zip(harmonies, real_delays):
+                    if h:
+                        cadence.append(old.Chord(h, de))
+                    else:
+                        cadence.append(old.Rest(de))
+                unit_count += 1
+
+    return old.JICadence(cadence).discard_rests()
+
+
 class TranslationTest(unittest.TestCase):
     def test_translation(self):
         u3 = metre.Unit(3)
@@ -85,3 +161,255 @@ class TranslationTest(unittest.TestCase):
         self.assertEqual(
             mdc8[0][0], ((p0, p_empty, p_empty), (p_empty, p_empty), (p_empty, p_empty))
         )
+
+    def test_divide_cadence_by_groups(self):
+        p0 = ji.JIHarmony([ji.r(1, 1)])
+        cadence = old.JICadence(
+            [old.Chord(p0, 1.5), old.Chord(p0, 1.5), old.Chord(p0, 1)]
+        )
+        divided = score.MDC.divide_cadence_by_groups(cadence, (1, 1, 1, 1), False)
+        self.assertEqual(tuple(len(c) for c in divided), (1, 2, 1, 1))
+        self.assertEqual(tuple(float(c.duration) for c in divided), (1, 1, 1, 1))
+        self.assertEqual(divided[1][0].pitch, ji.JIHarmony([]))
+        self.assertEqual(divided[1][1].pitch, p0)
+        divided = score.MDC.divide_cadence_by_groups(cadence, (1, 1, 1, 1), True)
+        self.assertEqual(divided[1][0].pitch, p0)
+
+        # long timeflows don't hit the recursion limit
+        cadence = old.JICadence([old.Chord(p0, 1) for i in range(5000)])
+        divided = score.MDC.divide_cadence_by_groups(cadence, (1,) * 5000, False)
+        self.assertEqual(len(divided), 5000)
+
+    def test_compact_mdc(self):
+        u2 = metre.Unit(2)
+        timeflow = metre.TimeFlow(metre.Metre(metre.Compound(u2, u2)))
+        p0 = ji.JIHarmony([ji.r(1, 1)])
+        p1 = ji.JIHarmony([ji.r(3, 2), ji.r(5, 4)])
+        cadence = old.JICadence(
+            [
+                old.Chord(p0, 1),
+                old.Chord(p1, 0.5),
+                old.Rest(0.25),
+                old.Chord(p1, 0.25),
+                old.Chord(p0, 2),
+            ]
+        )
+        mdc = score.MDC.mk_mdc_by_cadence(cadence, timeflow, 0, False)
+        compact = mdc.convert2compact()
+        self.assertEqual(compact.harmonies[0], mel.TheEmptyPitch)
+        self.assertEqual(compact.amount_units, 2)
+        self.assertEqual(tuple(compact.unit_positions[1]), (0, 0, 1))
+        self.assertEqual(compact.convert_unit2structure(1), tuple(mdc[0][0][1]))
+        self.assertEqual(repr(compact.convert2mdc()), repr(mdc))
+
+    def test_convert2cadence(self):
+        u3 = metre.Unit(3)
+        u2 = metre.Unit(2)
+        timeflow = metre.TimeFlow(
+            metre.Metre(metre.Compound(u3, u2)), metre.Metre(metre.Compound(u2, u2))
+        )
+        p0 = ji.JIHarmony([ji.r(1, 1)])
+        p1 = ji.JIHarmony([ji.r(3, 2), ji.r(5, 4)])
+        # divided elements, rests inside and between units
+        cadence = old.JICadence(
+            [
+                old.Chord(p0, 0.25),
+                old.Chord(p1, 0.75),
+                old.Rest(1),
+                old.Chord(p0, 1.5),
+                old.Chord(p1, 0.5),
+                old.Rest(0.125),
+                old.Chord(p0, 0.375),
+                old.Chord(p1, 1.5),
+                old.Rest(2),
+                old.Chord(p0, 1),
+            ]
+        )
+        mdc = score.MDC.mk_mdc_by_cadence(cadence, timeflow, 0, False)
+        divisions = int(tempo.TempoLine.divisions_per_element)
+        tempo_factors_per_unit = tuple(
+            tuple(np.linspace(start, 2, size * divisions) / divisions)
+            for start, size in zip((0.5, 1, 1.5, 1), timeflow.unit_size)
+        )
+        # the factors of the last unit end before its last event ends
+        tempo_factors_per_unit = tempo_factors_per_unit[:-1] + (
+            tempo_factors_per_unit[-1][: int(divisions * 1.75)],
+        )
+        for delays in (
+            (None,) * 4,
+            (old.Rest(0.5), None, old.Rest(1), old.Rest(0.25)),
+        ):
+            expected = convert2cadence_baseline(mdc, tempo_factors_per_unit, delays)
+            result = mdc.convert2cadence(tempo_factors_per_unit, delays)
+            self.assertEqual(
+                tuple((type(event), event.pitch) for event in result),
+                tuple((type(event), event.pitch) for event in expected),
+            )
+            for attribute in ("delay", "duration"):
+                np.testing.assert_allclose(
+                    tuple(float(event) for event in getattr(result, attribute)),
+                    tuple(float(event) for event in getattr(expected, attribute)),
+                )
+
+    def test_mdc_cache(self):
+        u2 = metre.Unit(2)
+        timeflow = metre.TimeFlow(metre.Metre(metre.Compound(u2, u2)))
+        p0 = ji.JIHarmony([ji.r(1, 1)])
+        score.MDC.cache.clear()
+        cadences = tuple(
+            old.JICadence([old.Chord(p0, 1) for i in range(timeflow.size)])
+            for i in range(2)
+        )
+        mdc0 = score.MDC.mk_mdc_by_cadence(cadences[0], timeflow, 0, False)
+        mdc1 = score.MDC.mk_mdc_by_cadence(cadences[1], timeflow, 0, False)
+        mdc2 = score.MDC.mk_mdc_by_cadence(cadences[1], timeflow, 0, True)
+        self.assertIs(mdc0, mdc1)
+        self.assertIsNot(mdc0, mdc2)
+        self.assertEqual(score.MDC.cache.cache_info()[:2], (1, 2))
+        self.assertEqual(len(score.MDC.cache), 2)
+
+    def test_mk_indices(self):
+        names = ("a", "b", "c")
+        self.assertEqual(score.Score.mk_indices(None, names, "section"), (0, 1, 2))
+        self.assertEqual(score.Score.mk_indices(("c", 0), names, "section"), (2, 0))
+        self.assertRaises(KeyError, score.Score.mk_indices, ("d",), names, "section")
+        self.assertRaises(IndexError, score.Score.mk_indices, (3,), names, "section")
+        instrument_indices = score.Score.mk_instrument_indices(
+            (score.Score.SIMPLIFIED_INSTRUMENTS[-1].name,)
+        )
+        self.assertEqual(instrument_indices, (6,))
+
+    def test_mk_preview_engine(self):
+        pyteq_engine = sound.PyteqEngine(volume=0.5)
+        preview_engine = score.Score.mk_preview_engine(pyteq_engine)
+        self.assertIsInstance(preview_engine, sound.PreviewEngine)
+        self.assertEqual(preview_engine.volume, 0.5)
+        sample_engine = sound.SampleEngine({})
+        self.assertIs(score.Score.mk_preview_engine(sample_engine), sample_engine)
+
+    def test_mk_section_stems(self):
+        pitch = ji.JIHarmony([ji.r(1, 1)])
+        cadences_per_section = tuple(
+            (old.JICadence([old.Chord(pitch, duration)]),) for duration in (2, 3)
+        )
+        stems = score.Score.mk_section_stems(("se",), cadences_per_section, (10, 4))
+        self.assertEqual(
+            tuple((stem[0], stem[3], stem[4]) for stem in stems),
+            (("0_10", 0, 10), ("0_4", 2, 4)),
+        )
+
+
+class BuildGraphTest(unittest.TestCase):
+    @staticmethod
+    def mk_score() -> score.Score:
+        sections = tuple(
+            ("s{0}".format(idx), tuple(range(7)), (None, None), None, None)
+            for idx in range(2)
+        )
+        with mock.patch.object(score.Score, "get_data_of_section"):
+            with mock.patch.object(
+                score.Score,
+                "convert2valid_sections",
+                return_value=(sections, (None, None), (None, None)),
+            ):
+                return score.Score("test", os.path.dirname(__file__), "s0", "s1")
+
+    def test_sound_without_notation(self):
+        stem = build.Node("sound/stem", "key", action=mock.Mock())
+        with mock.patch.object(score.Score, "mk_notation_section") as mk_section:
+            with mock.patch.object(score.Score, "mk_sound_nodes", return_value=(stem,)):
+                graph = self.mk_score().mk_build_graph(cache=False)
+                self.assertTrue(
+                    any(node.name.startswith("notation/") for node in graph.nodes)
+                )
+                with tempfile.TemporaryDirectory() as directory:
+                    graph = build.Graph(graph.nodes, os.path.join(directory, "b"))
+                    self.assertEqual(graph.stale(("sound",)), (stem,))
+        mk_section.assert_not_called()
+
+
+class RenderAndMixTest(unittest.TestCase):
+    profile = sound.RenderProfile("test", 1000, "double", 0.01)
+    mix_data = ((1, 0.5, 0), (1, 0.5, 0))
+
+    @staticmethod
+    def mk_stems(directory: str, engines_per_instrument: tuple) -> tuple:
+        stems_per_instrument = tuple(
+            tuple(
+                (
+                    os.path.join(directory, "{0}_{1}".format(ins_idx, idx)),
+                    None,
+                    se,
+                    0,
+                    None,
+                )
+                for idx, se in enumerate(engines)
+            )
+            for ins_idx, engines in enumerate(engines_per_instrument)
+        )
+        files = tuple(
+            os.path.join(directory, str(ins_idx))
+            for ins_idx in range(len(engines_per_instrument))
+        )
+        return stems_per_instrument, files
+
+    def test_render_and_mix(self):
+        def mtime(name: str) -> int:
+            return os.stat("{0}.wav".format(name)).st_mtime_ns
+
+        with tempfile.TemporaryDirectory() as directory:
+            stems, files = self.mk_stems(
+                directory, ((StubEngine(1),), (StubEngine(), StubEngine()))
+            )
+            name = os.path.join(directory, "mix")
+            score.Score.render_and_mix(
+                stems, files, self.mix_data, name, jobs=2, profile=self.profile
+            )
+            # the second instrument doesn't wait for the slow stem of the first one
+            self.assertLess(mtime(files[1]), mtime(stems[0][0][0]))
+            self.assertGreaterEqual(mtime(name), max(mtime(f) for f in files))
+            self.assertEqual(wav.WavReader("{0}.wav".format(name)).channels, 2)
+
+    def test_cancel_waiting_tasks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stems, files = self.mk_stems(
+                directory,
+                ((StubEngine(fail=True),), tuple(StubEngine(0.5) for i in range(6))),
+            )
+            name = os.path.join(directory, "mix")
+            self.assertRaises(
+                RuntimeError,
+                score.Score.render_and_mix,
+                stems,
+                files,
+                self.mix_data,
+                name,
+                jobs=2,
+                profile=self.profile,
+            )
+            rendered = tuple(
+                stem for stem in stems[1] if os.path.exists("{0}.wav".format(stem[0]))
+            )
+            self.assertLess(len(rendered), len(stems[1]))
+            for mix_name in files + (name,):
+                self.assertFalse(os.path.exists("{0}.wav".format(mix_name)))
+
+    def test_fail_fast(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stems, files = self.mk_stems(
+                directory, ((StubEngine(0.2, fail=True),), (StubEngine(5),))
+            )
+            name = os.path.join(directory, "mix")
+            start = time.time()
+            self.assertRaises(
+                RuntimeError,
+                score.Score.render_and_mix,
+                stems,
+                files,
+                self.mix_data,
+                name,
+                jobs=2,
+                profile=self.profile,
+            )
+            # the exception is raised before the slow stem is finished
+            self.assertLess(time.time() - start, 4)